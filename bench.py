@@ -0,0 +1,873 @@
+# Host benchmarks for humLogger_v1.py and microPython.py, run on CPython through hostsim.
+#
+#   python bench.py [--json results.json] [name ...]
+#
+# Times are CPython times and only meaningful relative to each other; SPI, file and virtual
+# clock figures are exact. --json writes every figure for regression tracking.
+#
+# The checks compare the incremental and cached paths of both scripts with a brute-force or
+# unoptimised reference and raise AssertionError on a mismatch. They run with the benchmarks
+# when no name is given.
+
+import ast
+import contextlib
+import io
+import gc
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from array import array
+
+import hostsim
+hostsim.install()
+
+from hostsim import Board
+import humLogger_v1 as app
+import microPython as mp
+
+
+startDir = os.getcwd()
+workDir = None  # the TemporaryDirectory the scripts currently run in
+
+
+def emptyDir():
+    # a new empty working directory for the scripts' files. Only the latest one is kept, so that
+    # a Logger built in it can still be restarted there; leaveDir() removes it at the end.
+    global workDir
+    leaveDir()
+    workDir = tempfile.TemporaryDirectory()
+    os.chdir(workDir.name)
+
+
+def leaveDir():
+    global workDir
+    os.chdir(startDir)
+    if workDir is not None:
+        workDir.cleanup()
+        workDir = None
+
+
+def drawSample(epd):
+    # roughly what Control.update() leaves in the framebuffer
+    epd.fill(0xff)
+    epd.text('YUZUIMO max1.23m/s 23.4C', 0, 8 - 1, 0x00)
+    epd.text('12.3km/week 1234m/day 567m/12h', 0, 16 + 2 - 1, 0x00)
+    epd.hline(0, 119, 216, 0x00)
+    epd.vline(0, 30, 122 - 32, 0x00)
+    epd.vline(0 + 216, 30, 122 - 32, 0x00)
+    for i in range(1, 216):
+        epd.line(i - 1, 119 - (i * 89) // 216, i, 119 - ((i + 1) * 89) // 216, 0x00)
+
+
+def timed(fn, number):
+    return min(timeit.repeat(fn, number = number, repeat = 3)) / number
+
+
+def benchDisplay():
+    Board.reset()
+    epd = app.EPD_2in13_V3_Landscape()
+    drawSample(epd)
+
+    sent = {}
+    result = {}
+    for mode, bulk in (('per-byte', False), ('page views', True)):
+        app.EPD_2in13_V3_Landscape.bulkTransfer = bulk
+
+        Board.resetSPI()
+        epd.write_ram(0x24, epd.buffer)
+        sent[mode] = Board.ramWrites(0x24)[0]
+        writes, transactions = Board.spiWrites, Board.transactions
+
+        Board.resetSPI()
+        t = timed(lambda: epd.write_ram(0x24, epd.buffer), 20 if bulk else 3)
+        print('display %-10s %8.3f ms/frame  spi.write %5d  CS %5d' % (mode, 1000 * t, writes, transactions))
+        result[mode] = {'ms': 1000 * t, 'writes': writes, 'transactions': transactions}
+
+    app.EPD_2in13_V3_Landscape.bulkTransfer = True
+    print('display identical RAM bytes:', sent['per-byte'] == sent['page views'])
+    result['identical'] = sent['per-byte'] == sent['page views']
+    return result
+
+
+def traced(fn):
+    tracemalloc.start()
+    keep = fn()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size
+
+
+def benchMemory():
+    # heap held by the Logger history: list of floats as parsed from the text logs vs arrays.
+    # On the board main() prints the same figure from gc.mem_free().
+    result = {}
+    for name, length in (('distance', app.Logger.weekLength), ('temp', app.Logger.displayLength)):
+        values = [str(round(random.uniform(1, 50), 1)) for x in range(length)]
+
+        def asList():
+            return [float(x) for x in values]
+
+        def asArray():
+            if name == 'temp':
+                a = app.FixedArray(length)
+            else:
+                a = array('f', bytes(4 * length))
+            for i in range(length):
+                a[i] = float(values[i])
+            return a
+
+        result[name] = {'list': traced(asList), 'array': traced(asArray)}
+        print('memory %-8s list %6d bytes  array %6d bytes' % (name, result[name]['list'], result[name]['array']))
+    return result
+
+
+def floatGraph(ctrl, scroll):
+    # Control.drawGraph() as it was before the fixed-point scales, the reference for benchRender:
+    # the temperature range from generators over logger.temp, the labels built every frame, and a
+    # float divide and round() per point. scroll draws only the newest column, as the scroll path did.
+    logger = ctrl.logger
+    W = app.Logger.weekLength
+    D = app.Logger.displayLength
+    distUpper = round(100 * math.ceil((logger.sumDisplay + 1) / 100))
+    ctrl.text(str(distUpper), 250 - 8 * 4 - 1, 31)
+    ctrl.text(str(round(distUpper / 2)), 250 - 8 * 4 - 1, 32 - 1 + 44)
+
+    tempLower = None
+    tempUpper = None
+    if 0 < sum((1 for x in logger.temp if 0 < x)):
+        tempLower = math.floor(min((x for x in logger.temp if 0 < x)) - 0.001)
+        tempUpper = math.ceil(max((x for x in logger.temp if 0 < x)) + 0.001)
+        ctrl.text(str(tempUpper) + 'C', 2, 32)
+        ctrl.epd.hline(1, 30, 5, 0x00)
+        ctrl.text(str(tempLower) + 'C', 2, 121 - 11)
+        ctrl.text(str(round((tempLower + tempUpper) / 2, 1)).replace('.0', 'C'), 2, 76)
+        ctrl.epd.hline(1, 74, 5, 0x00)
+
+    graph = ctrl.graph
+    bottom = 119 - app.Control.graphTop
+    if scroll:
+        total = ctrl.graphTotal / 100
+        d = logger.distance[logger.currentIndex]
+        graph.line(214, bottom - round(89 * total / distUpper), 215, bottom - round(89 * (total + d) / distUpper), 0)
+        t = logger.temp[logger.currentTempIndex]
+        if tempLower is not None and 0 < t:
+            graph.pixel(215, bottom - round(89 * (t - tempLower) / (tempUpper - tempLower)), 0)
+    else:
+        graph.fill(1)
+        distIter = (logger.distance[(logger.currentIndex + i) % W] for i in range(-1 * D + 1, 1))
+        total = next(distIter)
+        i = 1
+        for d in distIter:
+            graph.line(i - 1, bottom - round(89 * total / distUpper), i, bottom - round(89 * (total + d) / distUpper), 0)
+            total += d
+            i += 1
+        if tempLower is not None:
+            tempWindow = tempUpper - tempLower
+            for i in range(-1 * D + 1, 1):
+                idx = (logger.currentTempIndex + i) % D
+                if 0 < logger.temp[idx]:
+                    graph.pixel(i + 215, bottom - round(89 * (logger.temp[idx] - tempLower) / tempWindow), 0)
+
+    ctrl.epd.blit(graph, 0, app.Control.graphTop, 1)
+
+
+def benchRender():
+    # Control.drawGraph() with the framebuffer calls stubbed out, so that only the scale and
+    # per-point arithmetic is timed: a full plot, and the one-column scroll path, each next to
+    # floatGraph(), the float code it replaced.
+    emptyDir()
+    random.seed(1)
+
+    epd = app.EPD_2in13_V3_Landscape()
+    scheduler = app.Scheduler() # never run, the frames are drawn by hand
+    env = app.Environment('YUZUIMO', scheduler)
+    logger = app.Logger(env)
+    ctrl = app.Control(env, logger, app.Counter(0.16), epd, scheduler)
+
+    stub = lambda *args: None
+    for fb in ctrl.graphs:
+        fb.line = fb.pixel = fb.fill = stub
+    epd.blit = epd.hline = stub
+
+    for i in range(app.Logger.displayLength):
+        logger.update(round(random.uniform(20, 24), 1), random.choice((0.0, 0.0, random.uniform(0, 300))))
+
+    def full():
+        ctrl.graphScale = None
+        ctrl.drawGraph()
+
+    result = {'full': 1000 * timed(full, 50), 'fullFloat': 1000 * timed(lambda: floatGraph(ctrl, False), 50)}
+    print('render %-8s %8.3f ms/frame  (float reference %.3f)' % ('full', result['full'], result['fullFloat']))
+
+    # one idle sample per frame; only the frames that took the scroll path are counted
+    # the float reference draws the same frames' newest column after the timed drawGraph()
+    ctrl.drawGraph()
+    spent = 0.0
+    spentFloat = 0.0
+    frames = 0
+    for i in range(2 * app.Logger.displayLength):
+        logger.update(22.0, 0.0)
+        scrolls = ctrl.scrollCount
+        start = time.perf_counter()
+        ctrl.drawGraph()
+        if ctrl.scrollCount != scrolls:
+            spent += time.perf_counter() - start
+            start = time.perf_counter()
+            floatGraph(ctrl, True)
+            spentFloat += time.perf_counter() - start
+            frames += 1
+    result['scroll'] = 1000 * spent / max(1, frames)
+    result['scrollFloat'] = 1000 * spentFloat / max(1, frames)
+    print('render %-8s %8.3f ms/frame  (float reference %.3f, %d frames)' % ('scroll', result['scroll'], result['scrollFloat'], frames))
+    return result
+
+
+scripts = ('humLogger_v1.py', 'microPython.py')
+
+
+class Probe():
+
+    # CPU time and board counters over a stretch of the simulation
+
+    def __init__(self):
+        self.cpu = time.process_time()
+        self.clock = Board.clockMs
+        self.spi = Board.spiBytes
+        self.read = Board.fileRead
+        self.written = Board.fileWritten
+        self.opens = Board.fileOpens
+
+    def result(self):
+        return {
+            'cpuMs': 1000 * (time.process_time() - self.cpu),
+            'virtualMs': Board.clockMs - self.clock,
+            'spiBytes': Board.spiBytes - self.spi,
+            'fileRead': Board.fileRead - self.read,
+            'fileWritten': Board.fileWritten - self.written,
+            'fileOpens': Board.fileOpens - self.opens,
+        }
+
+
+def report(bench, script, result):
+    print('%-6s %-16s cpu %9.1f ms  virtual %10d ms  spi %9d B  read %8d B  written %8d B  opens %5d' % (
+        bench, script, result['cpuMs'], result['virtualMs'], result['spiBytes'], result['fileRead'], result['fileWritten'], result['fileOpens']))
+
+
+def boot(script):
+    # runs the script as on power-up, in an empty directory, on a fresh board
+    emptyDir()
+    Board.reset()
+    Board.recordStream = False
+    probe = Probe()
+    g = hostsim.runScript(os.path.join(here, script))
+    return g, probe.result()
+
+
+def benchBoot():
+    result = {}
+    for script in scripts:
+        g, result[script] = boot(script)
+        report('boot', script, result[script])
+    return result
+
+
+def benchUpdate():
+    # one Control update after five minutes of riding, with nothing else due meanwhile
+    result = {}
+    for script in scripts:
+        g, r = boot(script)
+        hostsim.wheel(600)
+        hostsim.run(g['scheduler'].due('control') - 1)
+        probe = Probe()
+        hostsim.run(2)
+        result[script] = probe.result()
+        report('update', script, result[script])
+    return result
+
+
+def benchWeek():
+    # a week of 5-minute updates (2016 of them), riding an hour every evening
+    result = {}
+    for script in scripts:
+        g, r = boot(script)
+        probe = Probe()
+        for day in range(7):
+            hostsim.run(18 * 60 * 60 * 1000)
+            hostsim.wheel(600)
+            hostsim.run(60 * 60 * 1000)
+            hostsim.wheel(None)
+            hostsim.run(5 * 60 * 60 * 1000)
+        result[script] = probe.result()
+        result[script]['sleepMs'] = Board.sleepMs
+        result[script]['wakeups'] = Board.wakeups
+        report('week', script, result[script])
+        g['scheduler'].dump()
+    return result
+
+
+def benchPhases():
+    # per-phase means from the scripts' own CycleStats ring over a day with an hour's ride.
+    # Phase times come from the virtual clock, so only the panel waits and sleeps show up.
+    result = {}
+    for script in scripts:
+        g, r = boot(script)
+        ctrl = g['ctrl']
+        stats = ctrl.stats = g['CycleStats'](288)
+        hostsim.run(12 * 60 * 60 * 1000)
+        hostsim.wheel(600)
+        hostsim.run(60 * 60 * 1000)
+        hostsim.wheel(None)
+        hostsim.run(11 * 60 * 60 * 1000)
+        rows = list(stats.rows())
+        result[script] = {f: sum(r[i] for r in rows) / len(rows) for i, f in enumerate(stats.fields)}
+        print('phases %-16s ' % script + '  '.join('%s %.0f' % (f, result[script][f]) for f in stats.fields))
+    return result
+
+
+def scriptFunctions(path):
+    # line number -> 'Class.function' for every line inside a function of a script
+    names = {}
+
+    def walk(node, prefix):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, ast.ClassDef):
+                walk(child, prefix + child.name + '.')
+            elif isinstance(child, ast.FunctionDef):
+                for line in range(child.lineno, child.end_lineno + 1):
+                    names[line] = prefix + child.name
+                walk(child, prefix + child.name + '.')
+    with open(path) as fp:
+        walk(ast.parse(fp.read()), '')
+    return names
+
+
+# What one idle 5-minute cycle may still allocate on the board, by script function. Anything else
+# must reuse what the cycle before left behind.
+allowedAlloc = {
+    'Environment.update': 'the date and time text of the new minute',
+    'Logger.update': 'boxed floats of the float32 week sum',
+    'Tier.push': 'boxed float of the partial hour distance',
+    'Logger.rollUp': 'the file object for the tier file',
+    'Control.plotColumn': 'boxed floats rounding the newest distance to cm',
+}
+
+
+def benchAlloc():
+    # heap held by the script across a day of idle 5-minute updates, after an hour's ride and two
+    # idle days to fill the text cache, which must not grow. Then the blocks allocated by one more
+    # cycle with the collector off, the script's own gc.collect() included, so that what the cycle
+    # allocates stays traced unless CPython's reference counting frees it first. 32-byte blocks are
+    # CPython ints: on the board ints below 2**30 are not allocated, so they are not counted.
+    result = {}
+    realCollect = sys.modules['gc'].collect
+    for script in scripts:
+        g, r = boot(script)
+        functions = scriptFunctions(os.path.join(here, script))
+        own = [tracemalloc.Filter(True, os.path.join(here, script))]
+        cache = g['ctrl'].textCache
+        hostsim.wheel(600)
+        hostsim.run(60 * 60 * 1000)
+        hostsim.wheel(None)
+
+        tracemalloc.start()
+        hostsim.run(2 * 24 * 60 * 60 * 1000)
+        before = tracemalloc.take_snapshot().filter_traces(own)
+        misses = cache.misses
+        hostsim.run(24 * 60 * 60 * 1000)
+        after = tracemalloc.take_snapshot().filter_traces(own)
+        tracemalloc.stop()
+        diff = after.compare_to(before, 'lineno')
+
+        sys.modules['gc'].collect = lambda: None
+        gc.disable()
+        tracemalloc.start()
+        hostsim.run(5 * 60 * 1000)
+        cycle = tracemalloc.take_snapshot().filter_traces(own).statistics('lineno')
+        tracemalloc.stop()
+        gc.enable()
+        sys.modules['gc'].collect = realCollect
+
+        blocks = {}
+        for stat in cycle:
+            if stat.size == 32 * stat.count:
+                continue
+            name = functions.get(stat.traceback[0].lineno, stat.traceback[0])
+            blocks[name] = blocks.get(name, 0) + stat.count
+        unexpected = {name: n for name, n in blocks.items() if name not in allowedAlloc}
+        assert not unexpected, (script, unexpected)
+
+        result[script] = {
+            'cycle': sum(blocks.values()),
+            'allowed': blocks,
+            'grown': sum(d.size_diff for d in diff),
+            'blocks': sum(d.count_diff for d in diff),
+            'misses': cache.misses - misses,
+        }
+        assert result[script]['blocks'] <= 0, script
+        print('alloc  %-16s %2d blocks/cycle (%s)  grown %6d B/day  blocks %4d  text cache misses %4d/day' % (
+            script, result[script]['cycle'], ', '.join('%s %d' % kv for kv in sorted(blocks.items())),
+            result[script]['grown'], result[script]['blocks'], result[script]['misses']))
+    return result
+
+
+modules = {'humLogger_v1.py': app, 'microPython.py': mp}
+
+
+def fresh(module):
+    # the script's Environment and Logger built by hand in an empty directory, on a fresh board
+    emptyDir()
+    Board.reset()
+    scheduler = module.Scheduler() # never run
+    if module is app:
+        env = app.Environment('YUZUIMO', scheduler)
+        return env, app.Logger(env)
+    env = mp.Environment(scheduler, dt = (2023, 2, 27, 0, 21, 30, 0, 0))
+    return env, mp.Logger(env.dtTuple, env)
+
+
+def logSample(module, env, logger, temp, dist):
+    if module is app:
+        logger.update(temp, dist)
+    else:
+        logger.update(temp, env.dtTuple, dist)
+
+
+def checkSums():
+    # Logger's sliding distance sums against a fresh sum over the ring after every update,
+    # for three weeks of samples, so that the sums go round the ring and through resync()
+    result = {}
+    for script, module in modules.items():
+        random.seed(6)
+        env, logger = fresh(module)
+        W = module.Logger.weekLength
+        windows = {
+            'sumWeek': W,
+            'sumDay': module.Logger.dayLength,
+            'sumHalfDay': module.Logger.halfDayLength,
+            'sumDisplay': module.Logger.displayLength,
+        }
+        worst = 0.0
+        for n in range(3 * W):
+            dist = random.choice((0.0, 0.0, 0.0, random.uniform(0, 300)))
+            logSample(module, env, logger, 22.0, dist)
+            for name, length in windows.items():
+                expected = sum(logger.distance[(logger.currentIndex - k) % W] for k in range(length))
+                error = abs(getattr(logger, name) - expected)
+                assert error < 1e-3, '%s %s off by %g after %d updates' % (script, name, error, n + 1)
+                worst = max(worst, error)
+        result[script] = {'updates': 3 * W, 'maxError': worst}
+        print('sums   %-16s %5d updates  max error %.3g m' % (script, 3 * W, worst))
+    return result
+
+
+def newCounter(module, pio = False):
+    # a Counter on GP4 of a fresh board, in an empty directory
+    emptyDir()
+    Board.reset()
+    return module.Counter(0.16, pio = pio) if module is app else module.Counter(pio = pio)
+
+
+def revolutions(counter):
+    return round(counter.distance / counter.unit)
+
+
+def magnetPass(edges, gap):
+    # one pass of the magnet: the reed switch closes edges times, gap ms apart, as it bounces
+    pin = hostsim.Pin(Board.WHEEL_PIN)
+    for k in range(edges):
+        pin.drive(0)
+        hostsim.advance(gap // 2)
+        pin.drive(1)
+        hostsim.advance(gap - gap // 2)
+
+
+def checkEdges():
+    # every pass bounces 4 times at 500 Hz and the scheduled handler only gets to run every
+    # 10 passes, as when the main loop is busy with the panel: the IRQ ring must hold them all
+    result = {}
+    for script, module in modules.items():
+        counter = newCounter(module)
+        hostsim.advance(1000)
+        passes = 300
+        for n in range(passes):
+            magnetPass(4, 2)
+            hostsim.advance(400 - 8)
+            if n % 10 == 9:
+                hostsim.runScheduled()
+        hostsim.runScheduled()
+        result[script] = {'passes': passes, 'counted': revolutions(counter), 'lost': counter.tickLost}
+        print('edges  %-16s %4d passes  %4d counted  %d edges lost' % (script, passes, result[script]['counted'], counter.tickLost))
+        assert counter.tickLost == 0, script
+        assert revolutions(counter) == passes, script
+    return result
+
+
+def checkMaxSpeed():
+    # Counter.maxSpeed() against a linear scan over the last SpeedCountMax records, as the
+    # original update() did, for random speeds and gaps. Only humLogger_v1.py keeps speeds.
+    # With the short window records leave by age, with the default one by ring overwrite.
+    result = {}
+    for window, gap in ((5000, 50), (18 * 60 * 60 * 1000, 10000)):
+        random.seed(11)
+        counter = newCounter(app)
+        counter.maxSpeedWindow = window
+        now = hostsim.ticks_ms()
+        records = [(now, counter.speedValues[0])] # the boot record
+        queries = 0
+        for n in range(20000):
+            now = hostsim.ticks_add(now, random.randint(0, gap))
+            if random.random() < 0.7:
+                speed = array('f', [round(random.uniform(0, 3), 2)])[0] # as stored in float32
+                counter.pushSpeed(now, speed)
+                records = (records + [(now, speed)])[-app.Counter.SpeedCountMax:]
+            expected = max([s for t, s in records if hostsim.ticks_diff(now, t) < window] or [0.0])
+            assert counter.maxSpeed(now) == expected, 'window %d, step %d' % (window, n)
+            queries += 1
+        result[window] = {'queries': queries}
+        print('speed  window %8d ms  %5d queries match the linear scan' % (window, queries))
+    return result
+
+
+def checkPio():
+    # a Counter in IRQ mode and one in PIO mode watching the same simulated GP4. Each pass
+    # bounces 1-4 times within the state machine's 32 ms settle time. The PIO side runs on
+    # hostsim.StateMachine, a behavioural model of pioEdgeCounter, not on the PIO program itself,
+    # so this checks how Counter drives and reads the state machine; the program only runs on the board.
+    result = {}
+    for script, module in modules.items():
+        random.seed(12)
+        irq = newCounter(module)
+        pio = module.Counter(0.16, pio = True) if module is app else module.Counter(pio = True)
+        hostsim.advance(1000)
+        passes = 300
+        for n in range(passes):
+            edges = random.randint(1, 4)
+            magnetPass(edges, 4)
+            hostsim.advance(400 - 4 * edges)
+            hostsim.runScheduled()
+        pio.process(0)
+        result[script] = {'passes': passes, 'irq': revolutions(irq), 'pio': revolutions(pio)}
+        print('pio    %-16s %4d passes  irq %4d  pio %4d' % (script, passes, revolutions(irq), revolutions(pio)))
+        assert revolutions(irq) == revolutions(pio) == passes, script
+        # microPython.py only reads the count, so its program must not raise the irq at all
+        assert module is app or pio.sm.irqs == 0, (script, pio.sm.irqs)
+    return result
+
+
+def checkDebounce():
+    # the adaptive debounce must not lock out a wheel that speeds up at once: 10 slow
+    # revolutions to settle the period estimate, then 100 at three times the speed. A gradual
+    # speed-up with bounce is counted in full too. A jump to 150 ms, below the old fixed 250 ms,
+    # may lose a few revolutions while the estimate comes down, but not more.
+    runs = {
+        'sudden': [(1670, 1)] * 10 + [(500, 1)] * 100,
+        'gradual': [(1000 - 3 * n, 3) for n in range(300)],
+        'fast': [(667, 1)] * 10 + [(150, 3)] * 200,
+    }
+    result = {}
+    for script, module in modules.items():
+        result[script] = {}
+        for name, passes in runs.items():
+            counter = newCounter(module)
+            hostsim.advance(1000)
+            for period, edges in passes:
+                magnetPass(edges, 4)
+                hostsim.advance(period - 4 * edges)
+                hostsim.runScheduled()
+            result[script][name] = {'passes': len(passes), 'counted': revolutions(counter)}
+            print('bounce %-16s %-8s %4d passes  %4d counted' % (script, name, len(passes), revolutions(counter)))
+        for name in ('sudden', 'gradual'):
+            assert result[script][name]['counted'] == result[script][name]['passes'], (script, name)
+        assert result[script]['fast']['passes'] - 10 <= result[script]['fast']['counted'], script
+    return result
+
+
+def rides(n):
+    # n 5-minute samples of (temperature, distance): rides of a few samples between idle stretches
+    riding = False
+    temp = 22.0
+    for i in range(n):
+        if random.random() < (0.3 if riding else 0.05):
+            riding = not riding
+        temp = min(26.0, max(18.0, temp + random.choice((-0.1, 0.0, 0.0, 0.1))))
+        yield round(temp, 1), random.uniform(20, 300) if riding else 0.0
+
+
+def checkScroll():
+    # every frame that took the scroll path against a full plot of the same samples
+    result = {}
+    for script, module in modules.items():
+        random.seed(16)
+        env, logger = fresh(module)
+        ctrl = module.Control(env, logger, module.Counter(0.16) if module is app else module.Counter(), module.EPD_2in13_V3_Landscape(), module.Scheduler())
+        scrolls = 0
+        differ = 0
+        for temp, dist in rides(3 * module.Logger.dayLength):
+            logSample(module, env, logger, temp, dist)
+            count = ctrl.scrollCount
+            ctrl.drawGraph()
+            if ctrl.scrollCount == count:
+                continue
+            scrolls += 1
+            scrolled = bytes(ctrl.graphViews[ctrl.graphSide])
+            ctrl.graphScale = None
+            ctrl.drawGraph()
+            if scrolled != bytes(ctrl.graphViews[ctrl.graphSide]):
+                differ += 1
+        result[script] = {'scrolls': scrolls, 'differ': differ}
+        print('scroll %-16s %4d scrolls  %d differ from a full plot' % (script, scrolls, differ))
+        assert 0 < scrolls and differ == 0, script
+    return result
+
+
+def checkWindow():
+    # display_Partial() with the dirtyRegion() window, replayed through hostsim.Panel after every
+    # frame, against a full-frame upload of the same buffer. Frames change a few random rectangles,
+    # pixels or nothing, starting from a blank panel RAM, so the first frame goes out whole.
+    result = {}
+    for script, module in modules.items():
+        random.seed(3)
+        Board.reset()
+        epd = module.EPD_2in13_V3_Landscape()
+        panel = hostsim.Panel(epd.width // 8, epd.height)
+        epd.fill(0xff)
+        windowed = 0
+        for frame in range(200):
+            for k in range(random.choice((0, 1, 1, 2, 5))):
+                if random.random() < 0.5:
+                    epd.pixel(random.randrange(epd.width), random.randrange(epd.height), random.randint(0, 1))
+                else:
+                    epd.fill_rect(random.randrange(epd.width), random.randrange(epd.height),
+                                  random.randint(1, 40), random.randint(1, 40), random.randint(0, 1))
+            region = epd.dirtyRegion(epd.buffer)
+            Board.resetSPI()
+            if region is not None:
+                epd.display_Partial(epd.buffer, region)
+                windowed += region != (0, epd.width // 8 - 1, 0, epd.height - 1)
+            panel.replay()
+
+            full = hostsim.Panel(epd.width // 8, epd.height)
+            full.replay([[0, bytearray((0x24,))], [1, bytearray(b''.join(epd.pages(epd.buffer)))]])
+            assert panel.ram[0x24] == full.ram[0x24], (script, frame, region)
+        result[script] = {'frames': 200, 'windowed': windowed}
+        print('window %-16s %d frames, %d sent as a window, panel RAM matches a full-frame upload' % (script, 200, windowed))
+    return result
+
+
+def checkTempStats():
+    # Logger.tempStats (valid count, min and max of the plotted temperatures) against a scan of
+    # the last displayLength samples, over three days with stretches of sensor dropouts long
+    # enough to empty the window
+    result = {}
+    for script, module in modules.items():
+        random.seed(17)
+        env, logger = fresh(module)
+        n = module.Logger.displayLength
+        ring = logger.temp.raw
+        head = (lambda: logger.currentTempIndex) if module is app else (lambda: logger.currentIndex)
+        valid = True
+        empty = 0
+        for temp, dist in rides(3 * module.Logger.dayLength):
+            if random.random() < (0.005 if valid else 0.002):
+                valid = not valid
+            if valid and random.random() < 0.02:
+                temp = -1 # a single bad reading
+            logSample(module, env, logger, temp if valid else -1, dist)
+            window = [ring[(head() - k) % len(ring)] for k in range(n)]
+            window = [t for t in window if t]
+            stats = logger.tempStats
+            assert stats.count == len(window), script
+            assert stats.min() == min(window or [0]) and stats.max() == max(window or [0]), script
+            empty += not window
+        result[script] = {'updates': 3 * module.Logger.dayLength, 'empty': empty}
+        print('temp   %-16s %4d updates match the scan  (%d with no valid sample)' % (script, 3 * module.Logger.dayLength, empty))
+    return result
+
+
+def checkTiers():
+    # Tier.total() and tempRange() against a scan of the ring, on a small tier that wraps many
+    # times, then Logger.report() over a day of samples
+    result = {}
+    for script, module in modules.items():
+        random.seed(22)
+        tier = module.Tier(b'HUMt', 50, 3, 0)
+        tier.clear()
+        closed = 0
+        for temp, dist in rides(6000):
+            t = 0 if random.random() < 0.1 else round(10 * temp)
+            if not tier.push(dist, t, t, t):
+                continue
+            closed += 1
+            for n in (1, 24, 49, 50, 60):
+                last = [(tier.currentIndex - k) % tier.length for k in range(min(n, tier.length))]
+                assert tier.total(n) == sum(tier.distance[i] for i in last), (script, n)
+                valid = [i for i in last if tier.tempMean[i]]
+                expected = (min(tier.tempMin[i] for i in valid), max(tier.tempMax[i] for i in valid)) if valid else (0, 0)
+                assert tier.tempRange(n) == expected, (script, n)
+
+        env, logger = fresh(module)
+        for temp, dist in rides(module.Logger.dayLength):
+            logSample(module, env, logger, temp, dist)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            logger.report()
+        assert len(out.getvalue().splitlines()) == 5, script
+        result[script] = {'closed': closed}
+        print('tiers  %-16s %4d closed entries match the scan' % (script, closed))
+    return result
+
+
+def tierState(t):
+    # everything a Tier keeps, with the partial distance and the running sum last
+    return (t.currentIndex % t.length, t.count, t.tempSum, t.tempCount, t.minAcc, t.maxAcc,
+            bytes(t.distance), bytes(t.tempMin), bytes(t.tempMax), bytes(t.tempMean), t.distAcc, t.sum)
+
+
+def sameTier(a, b):
+    # the partial distance of a tier is a float32 in the file but a double on the host, so after a
+    # reload it may differ in the last float32 bit. On the board floats are float32 throughout.
+    return a[:-2] == b[:-2] and all(abs(x - y) <= 1e-6 * max(1.0, abs(x)) for x, y in zip(a[-2:], b[-2:]))
+
+
+def checkGap():
+    # microPython.py switched off for a while and restarted: the tiers must end up as if an empty
+    # sample had been rolled up for every 5 minute slot that was missed, for gaps from a few slots
+    # to longer than the daily ring
+    random.seed(24)
+    for gap in (1, 7, 11, 12, 13, 150, 289, 2016, 20000, 400000):
+        env, logger = fresh(mp)
+        start = logger.epoch(env.dtTuple)
+        samples = random.randint(1, 600)
+        for k, (temp, dist) in enumerate(rides(samples)):
+            t = mp.time.localtime(start + mp.Logger.slotSeconds * k)
+            logger.update(temp, (t[0], t[1], t[2], t[6], t[3], t[4], t[5], 0), dist)
+
+        # the reference restarts in time for the next slot and rolls the empty samples up itself, so
+        # that it too starts from the float32 partial distances in the file
+        t = mp.time.localtime(start + mp.Logger.slotSeconds * samples)
+        reference = mp.Logger((t[0], t[1], t[2], t[6], t[3], t[4], t[5], 0), env)
+        for k in range(gap):
+            if reference.hourly.push(0.0, 0, 0, 0):
+                reference.daily.push(*reference.hourly.latest())
+
+        t = mp.time.localtime(start + mp.Logger.slotSeconds * (samples + gap))
+        restarted = mp.Logger((t[0], t[1], t[2], t[6], t[3], t[4], t[5], 0), env)
+        for a, b in zip(reference.tiers, restarted.tiers):
+            assert sameTier(tierState(a), tierState(b)), (gap, a.magic)
+
+        # a second restart before the next sample must find the same rings and not skip the gap again
+        again = mp.Logger((t[0], t[1], t[2], t[6], t[3], t[4], t[5], 0), env)
+        for a, b in zip(restarted.tiers, again.tiers):
+            assert sameTier(tierState(a), tierState(b)), (gap, a.magic)
+        assert again.currentIndex % mp.Logger.weekLength == restarted.currentIndex % mp.Logger.weekLength, gap
+        assert bytes(again.distance) == bytes(restarted.distance), gap
+    print('gap    microPython.py   tiers after restarts with gaps of 1 to 400000 slots match the empty samples')
+    return {}
+
+
+def committed(logger):
+    # what Logger keeps on flash: ring, indices, sequence numbers and the tiers as their files hold them
+    return (logger.seq, logger.tierSeq, logger.currentIndex % app.Logger.weekLength, logger.currentTempIndex % app.Logger.displayLength,
+            bytes(logger.distance), bytes(logger.temp.raw), tuple(tierState(t) for t in logger.tiers))
+
+
+def sameCommitted(a, b):
+    return a[:6] == b[:6] and all(sameTier(ta, tb) for ta, tb in zip(a[6], b[6]))
+
+
+def checkPowerCut():
+    # humLogger_v1.py cut off at a random write, or at a random moment, then restarted from what
+    # is left in the directory. Checkpoints every 6 hours instead of weekly, so that cuts land in
+    # them too. The restarted Logger must hold the state of the last completed flush: the
+    # journal blocks written so far, replayed over the last complete checkpoint.
+    random.seed(23)
+    env, logger = fresh(app)
+    empty = committed(logger) # the boot checkpoint, before the first sample
+    runs = 100
+    cuts = 0
+    inCheckpoint = 0
+    for run in range(runs):
+        g, r = boot('humLogger_v1.py')
+        g['Logger'].checkpointInterval = 6
+        logger = g['logger']
+        flushed = [empty]
+        flush = logger.flush
+
+        def flushAndKeep():
+            flush()
+            flushed.append(committed(logger))
+        logger.flush = flushAndKeep
+
+        hostsim.wheel(random.choice((None, 600, 1500)))
+        hostsim.run(random.randint(0, 12 * 60 * 60 * 1000))
+        Board.writeBudget = random.choice((random.randint(0, 200), random.randint(0, 100000)))
+        try:
+            hostsim.run(12 * 60 * 60 * 1000)
+        except hostsim.PowerLoss:
+            cuts += 1
+
+        # a cut during the checkpoint comes after the last block is in the journal
+        expected = committed(logger) if logger.pendingCount == 0 else flushed[-1]
+        inCheckpoint += any(name.endswith('.tmp') for name in os.listdir())
+
+        Board.reset()
+        env = app.Environment('YUZUIMO', app.Scheduler())
+        assert sameCommitted(committed(app.Logger(env)), expected), 'run %d' % run
+    print('power  humLogger_v1.py  %d runs, %d cut part way through a write (%d in a checkpoint), all recovered' % (runs, cuts, inCheckpoint))
+    return {'runs': runs, 'cuts': cuts, 'inCheckpoint': inCheckpoint}
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+checks = {
+    'sums': checkSums,
+    'edges': checkEdges,
+    'maxspeed': checkMaxSpeed,
+    'pio': checkPio,
+    'debounce': checkDebounce,
+    'scroll': checkScroll,
+    'window': checkWindow,
+    'tempstats': checkTempStats,
+    'tiers': checkTiers,
+    'gap': checkGap,
+    'powercut': checkPowerCut,
+}
+
+benchmarks = {
+    'display': benchDisplay,
+    'memory': benchMemory,
+    'render': benchRender,
+    'boot': benchBoot,
+    'update': benchUpdate,
+    'week': benchWeek,
+    'phases': benchPhases,
+    'alloc': benchAlloc,
+}
+
+
+if __name__ == '__main__':
+
+    args = sys.argv[1:]
+    output = None
+    if '--json' in args:
+        i = args.index('--json')
+        output = args[i + 1]
+        del args[i:i + 2]
+
+    results = {}
+    registry = dict(benchmarks, **checks)
+    try:
+        for name in (args or registry):
+            results[name] = registry[name]()
+    finally:
+        leaveDir()
+
+    if output:
+        with open(output, 'w') as fp:
+            json.dump(results, fp, indent = 1, sort_keys = True)
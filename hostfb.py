@@ -0,0 +1,135 @@
+# Pure Python stand-in for MicroPython's framebuf module (MONO_VLSB only), used by hostsim.
+# Pixel layout matches the firmware so that SPI output can be compared byte for byte.
+# text() draws a fixed 8x8 pattern per character instead of the real font.
+
+MONO_VLSB = 0
+MONO_HLSB = 3
+MONO_HMSB = 4
+
+
+class FrameBuffer():
+
+    def __init__(self, buffer, width, height, format = MONO_VLSB, stride = None):
+        if format != MONO_VLSB:
+            raise ValueError('only MONO_VLSB is supported')
+        self._buf = buffer
+        self._w = width
+        self._h = height
+        self._stride = width if stride is None else stride
+
+    def _set(self, x, y, c):
+        if 0 <= x < self._w and 0 <= y < self._h:
+            i = (y >> 3) * self._stride + x
+            if c:
+                self._buf[i] |= 1 << (y & 7)
+            else:
+                self._buf[i] &= ~(1 << (y & 7)) & 0xff
+
+    def _get(self, x, y):
+        return (self._buf[(y >> 3) * self._stride + x] >> (y & 7)) & 1
+
+    def fill(self, c):
+        v = 0xff if c else 0x00
+        for i in range(((self._h + 7) >> 3) * self._stride):
+            self._buf[i] = v
+
+    def pixel(self, x, y, c = None):
+        if c is None:
+            if 0 <= x < self._w and 0 <= y < self._h:
+                return self._get(x, y)
+            return None
+        self._set(x, y, c)
+
+    def fill_rect(self, x, y, w, h, c):
+        for yy in range(max(y, 0), min(y + h, self._h)):
+            for xx in range(max(x, 0), min(x + w, self._w)):
+                self._set(xx, yy, c)
+
+    def hline(self, x, y, w, c):
+        self.fill_rect(x, y, w, 1, c)
+
+    def vline(self, x, y, h, c):
+        self.fill_rect(x, y, 1, h, c)
+
+    def rect(self, x, y, w, h, c, f = False):
+        if f:
+            self.fill_rect(x, y, w, h, c)
+        else:
+            self.fill_rect(x, y, w, 1, c)
+            self.fill_rect(x, y + h - 1, w, 1, c)
+            self.fill_rect(x, y, 1, h, c)
+            self.fill_rect(x + w - 1, y, 1, h, c)
+
+    def line(self, x1, y1, x2, y2, c):
+        # same Bresenham walk as modframebuf.c
+        dx = x2 - x1
+        sx = 1 if 0 < dx else -1
+        dx = abs(dx)
+        dy = y2 - y1
+        sy = 1 if 0 < dy else -1
+        dy = abs(dy)
+        steep = dx < dy
+        if steep:
+            x1, y1 = y1, x1
+            dx, dy = dy, dx
+            sx, sy = sy, sx
+        e = 2 * dy - dx
+        for i in range(dx):
+            if steep:
+                self._set(y1, x1, c)
+            else:
+                self._set(x1, y1, c)
+            while 0 <= e:
+                y1 += sy
+                e -= 2 * dx
+            x1 += sx
+            e += 2 * dy
+        self._set(x2, y2, c)
+
+    def text(self, s, x, y, c = 1):
+        for ch in s:
+            code = ord(ch)
+            if code != 32:
+                for col in range(8):
+                    bits = (code * (col + 3) * 37) & 0x7e
+                    for row in range(8):
+                        if bits >> row & 1:
+                            self._set(x + col, y + row, c)
+            x += 8
+
+    def blit(self, fbuf, x, y, key = -1, palette = None):
+        if (palette is None and key in (-1, 0, 1) and not (y | fbuf._h) & 7
+                and 0 <= x and x + fbuf._w <= self._w and 0 <= y and y + fbuf._h <= self._h):
+            # whole pages: a per-byte and/or/copy gives the same result as the pixel walk
+            for page in range(fbuf._h >> 3):
+                d = ((y >> 3) + page) * self._stride + x
+                s = page * fbuf._stride
+                for i in range(fbuf._w):
+                    if key == 1:
+                        self._buf[d + i] &= fbuf._buf[s + i]
+                    elif key == 0:
+                        self._buf[d + i] |= fbuf._buf[s + i]
+                    else:
+                        self._buf[d + i] = fbuf._buf[s + i]
+            return
+        for yy in range(fbuf._h):
+            for xx in range(fbuf._w):
+                c = fbuf._get(xx, yy)
+                if c != key:
+                    self._set(x + xx, y + yy, c)
+
+    def scroll(self, xstep, ystep):
+        if xstep < 0:
+            sx, xend, dx = 0, self._w + xstep, 1
+        else:
+            sx, xend, dx = self._w - 1, xstep - 1, -1
+        if ystep < 0:
+            y, yend, dy = 0, self._h + ystep, 1
+        else:
+            y, yend, dy = self._h - 1, ystep - 1, -1
+        while y != yend:
+            x = sx
+            while x != xend:
+                self._set(x, y, self._get(x - xstep, y - ystep))
+                x += dx
+            y += dy
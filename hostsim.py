@@ -0,0 +1,636 @@
+# Host-side stand-ins for the MicroPython modules used by humLogger_v1.py and microPython.py.
+#
+#   import hostsim
+#   hostsim.install()
+#   import humLogger_v1
+#
+# SPI traffic is recorded on Board so that the bytes sent to the panel and the number
+# of CS transactions can be compared between driver versions on Linux.
+#
+# The whole script can also be run on a virtual clock:
+#
+#   hostsim.install()
+#   g = hostsim.runScript('humLogger_v1.py')    # boots it as __main__ in the current directory
+#   hostsim.wheel(600)                          # one revolution every 600 ms
+#   hostsim.run(60 * 60 * 1000)                 # an hour of scheduler steps and wheel edges
+#
+# The script's main loop sleeps in machine.lightsleep(); the fake stops it by raising Halt
+# there once the run is over, and run() enters the loop again. Wheel edges interrupt whatever
+# is running, like the hard IRQ on GP4, and end a lightsleep early. Timer callbacks fire when
+# they fall due during a lightsleep or a run() without a main loop. File I/O done through
+# the script's open() is counted on Board, and Board.writeBudget cuts the power part way
+# through a write to test recovery.
+
+import builtins
+import calendar
+import datetime
+import gc as _gc
+import sys
+import time as _time
+import tracemalloc
+import types
+
+
+class Board():
+
+    levels = {}         # pin id -> level
+    handlers = {}       # pin id -> [handler, trigger]
+    watchers = {}       # pin id -> [callback(level)] for peripherals sampling the pin (PIO)
+    pins = {}           # pin id -> Pin (last created)
+
+    DC_PIN = 8
+    CS_PIN = 9
+    BUSY_PIN = 13
+    busyTimes = {0x12: 10, 0x20: 2000}     # command -> ms the simulated panel holds BUSY
+
+    clockMs = 0
+    adc = {}            # ADC channel -> read_u16() value
+
+    scheduleDepth = 8       # MICROPY_SCHEDULER_DEPTH
+
+    WHEEL_PIN = 4
+    heapSize = 192 * 1024   # what gc.mem_free() starts from on the Pico
+    recordStream = True     # keep spiStream; turn off for long runs that only need the counts
+
+    @classmethod
+    def reset(cls):
+        cls.levels = {Board.BUSY_PIN: 0}
+        cls.handlers = {}
+        cls.watchers = {}
+        cls.pins = {}
+        cls.clockMs = 0
+        cls.adc = {4: 14191}    # on-chip temperature sensor at about 22 C
+        cls.busyUntil = None
+        cls.scheduled = []      # [callback, arg] queued by micropython.schedule()
+        cls.timers = []         # active Timers
+        cls.wheelPeriod = None  # ms per revolution, None while the wheel stands still
+        cls.wheelContact = 20   # ms the magnet holds the reed switch closed
+        cls.wheelNext = None    # ms of the next wheel edge
+        cls.haltMs = None       # lightsleep() raises Halt from here on
+        cls.mainLoop = None     # what run() calls to resume the script's main loop
+        cls.sleepMs = 0         # time spent in lightsleep()
+        cls.wakeups = 0
+        cls.recordStream = True
+        cls.resetSPI()
+        cls.resetFiles()
+
+    @classmethod
+    def resetSPI(cls):
+        cls.spiStream = []      # [dc, bytearray] runs in the order they were sent
+        cls.spiBytes = 0
+        cls.spiWrites = 0
+        cls.transactions = 0
+        cls.commands = 0
+        cls.pending = False
+
+    @classmethod
+    def resetFiles(cls):
+        cls.fileOpens = 0
+        cls.fileRead = 0
+        cls.fileWritten = 0
+        cls.writeBudget = None  # bytes that may still be written before PowerLoss
+
+    @classmethod
+    def ramWrites(cls, command):
+        # bytes written after each occurrence of command (0x24 / 0x26 ...)
+        result = []
+        current = None
+        for dc, data in cls.spiStream:
+            if dc == 0:
+                current = None
+                if data[-1] == command:
+                    current = bytearray()
+                    result.append(current)
+            elif current is not None:
+                current.extend(data)
+        return result
+
+
+class Panel():
+
+    # replays Board.spiStream through the SSD1680 addressing used by the driver
+    # (data entry mode 0x07: X and Y increment, Y first) and keeps the 0x24/0x26 RAM
+
+    def __init__(self, xbytes = 16, ylines = 250):
+        self.xbytes = xbytes
+        self.ylines = ylines
+        self.ram = {0x24: bytearray(b'\xff' * xbytes * ylines), 0x26: bytearray(b'\xff' * xbytes * ylines)}
+        self.window = [0, xbytes - 1, 0, ylines - 1]
+        self.x = 0
+        self.y = 0
+
+    def replay(self, stream = None):
+        command = None
+        args = bytearray()
+        for dc, data in (Board.spiStream if stream is None else stream):
+            if dc == 0:
+                for c in data:
+                    self.apply(command, args)
+                    command = c
+                    args = bytearray()
+            else:
+                if command in self.ram:
+                    for b in data:
+                        self.write(command, b)
+                else:
+                    args.extend(data)
+        self.apply(command, args)
+
+    def apply(self, command, args):
+        if command == 0x44 and len(args) == 2:
+            self.window[0:2] = [args[0], args[1]]
+        elif command == 0x45 and len(args) == 4:
+            self.window[2:4] = [args[0] | args[1] << 8, args[2] | args[3] << 8]
+        elif command == 0x4E and len(args) == 1:
+            self.x = args[0]
+        elif command == 0x4F and len(args) == 2:
+            self.y = args[0] | args[1] << 8
+
+    def write(self, command, b):
+        self.ram[command][self.x * self.ylines + self.y] = b
+        self.y += 1
+        if self.window[3] < self.y:
+            self.y = self.window[2]
+            self.x += 1
+            if self.window[1] < self.x:
+                self.x = self.window[0]
+
+
+class Pin():
+
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    def __init__(self, id, mode = -1, pull = -1, value = None):
+        self.id = id
+        if id not in Board.levels:
+            Board.levels[id] = 1 if pull == Pin.PULL_UP else 0
+        if value is not None:
+            Board.levels[id] = value
+        Board.pins[id] = self
+
+    def value(self, v = None):
+        if v is None:
+            return Board.levels[self.id]
+        self.drive(1 if v else 0)
+
+    def __call__(self, v = None):
+        return self.value(v)
+
+    def on(self):
+        self.drive(1)
+
+    def off(self):
+        self.drive(0)
+
+    def toggle(self):
+        self.drive(1 - Board.levels[self.id])
+
+    def irq(self, handler = None, trigger = IRQ_FALLING | IRQ_RISING, hard = False):
+        Board.handlers[self.id] = [handler, trigger]
+
+    def drive(self, v):
+        last = Board.levels[self.id]
+        Board.levels[self.id] = v
+        if self.id == Board.CS_PIN and v == 1 and last == 0 and Board.pending:
+            Board.transactions += 1
+            Board.pending = False
+        if last != v:
+            for watcher in Board.watchers.get(self.id, ()):
+                watcher(v)
+        if last != v and self.id in Board.handlers:
+            handler, trigger = Board.handlers[self.id]
+            if handler and trigger & (Pin.IRQ_FALLING if v == 0 else Pin.IRQ_RISING):
+                handler(self)
+
+
+class SPI():
+
+    def __init__(self, id, *args, **kwargs):
+        self.id = id
+
+    def init(self, *args, **kwargs):
+        pass
+
+    def write(self, buf):
+        data = bytes(buf)
+        dc = Board.levels.get(Board.DC_PIN, 0)
+        if dc == 0:
+            Board.commands += len(data)
+            if data[-1] in Board.busyTimes:
+                Board.busyUntil = Board.clockMs + Board.busyTimes[data[-1]]
+                Board.levels[Board.BUSY_PIN] = 1
+        if not Board.recordStream:
+            pass
+        elif Board.spiStream and Board.spiStream[-1][0] == dc and dc == 1:
+            Board.spiStream[-1][1].extend(data)
+        else:
+            Board.spiStream.append([dc, bytearray(data)])
+        Board.spiBytes += len(data)
+        Board.spiWrites += 1
+        Board.pending = True
+
+
+class Timer():
+
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id = -1, **kwargs):
+        self.callback = None
+        self.due = None
+        if kwargs:
+            self.init(**kwargs)
+
+    def init(self, mode = PERIODIC, period = -1, freq = -1, callback = None):
+        self.mode = mode
+        self.period = period if 0 <= period else 1000 // freq
+        self.callback = callback
+        self.due = Board.clockMs + self.period
+        if self not in Board.timers:
+            Board.timers.append(self)
+
+    def deinit(self):
+        self.callback = None
+        self.due = None
+        if self in Board.timers:
+            Board.timers.remove(self)
+
+    def fire(self):
+        if self.mode == Timer.PERIODIC:
+            self.due += self.period
+        else:
+            self.deinit()
+        if self.callback:
+            self.callback(self)
+
+
+class StateMachine():
+
+    # behaves like pioEdgeCounter in the scripts: counts falling edges on in_base into X (downwards),
+    # ignores the pin for settleCycles after the fall and after the rise, and raises the irq every
+    # (value put to the TX FIFO + 1) edges. exec() understands the two instructions used to read X.
+
+    settleCycles = 64
+
+    def __init__(self, id, program = None, freq = 125000000, in_base = None, **kwargs):
+        self.id = id
+        self.settleMs = 1000 * StateMachine.settleCycles // freq
+        self.pin = in_base.id
+        self.level = Board.levels[self.pin]
+        self.changedMs = Board.clockMs
+        self.waitFor = 0                # level the program is waiting for
+        self.readyMs = 0                # end of the delay before that wait
+        self.x = 0
+        self.y = 0
+        self.osr = 0
+        self.isr = 0
+        self.fifo = []
+        self.handler = None
+        self.irqs = 0                   # times the program raised its irq
+        self.running = False
+        Board.watchers.setdefault(self.pin, []).append(self.edge)
+
+    def active(self, v = None):
+        if v is None:
+            return self.running
+        self.running = bool(v)
+        self.y = self.osr
+        self.readyMs = Board.clockMs
+
+    def put(self, v):
+        self.osr = v & 0xffffffff
+
+    def get(self):
+        self.catchUp(Board.clockMs)
+        return self.fifo.pop(0)
+
+    def exec(self, instr):
+        self.catchUp(Board.clockMs)
+        if instr == 'mov(isr, x)':
+            self.isr = self.x
+        elif instr == 'push()':
+            self.fifo.append(self.isr)
+        else:
+            raise ValueError(instr)
+
+    def irq(self, handler = None, trigger = 0, hard = False):
+        self.handler = handler
+
+    def edge(self, level):
+        self.catchUp(Board.clockMs)
+        self.level = level
+        self.changedMs = Board.clockMs
+        self.catchUp(Board.clockMs)
+
+    def catchUp(self, now):
+        # run the program up to now; the level has been constant since changedMs
+        while self.running and self.level == self.waitFor:
+            at = max(self.readyMs, self.changedMs)
+            if now < at:
+                break
+            if self.waitFor == 0:
+                self.x = (self.x - 1) & 0xffffffff
+                if self.y == 0:
+                    self.y = self.osr
+                    self.irqs += 1
+                    if self.handler:
+                        schedule(self.handler, self)
+                else:
+                    self.y -= 1
+                self.waitFor = 1
+            else:
+                self.waitFor = 0
+            self.readyMs = at + self.settleMs
+
+
+class ADC():
+
+    def __init__(self, channel):
+        self.channel = channel.id if isinstance(channel, Pin) else channel
+
+    def read_u16(self):
+        return Board.adc.get(self.channel, 0)
+
+
+class RTC():
+
+    # keeps running on the virtual clock from the moment it was set
+    dt = (2000, 1, 1, 5, 0, 0, 0, 0)
+    setMs = 0
+
+    def datetime(self, dt = None):
+        if dt is not None:
+            RTC.dt = tuple(dt)
+            RTC.setMs = Board.clockMs
+            return
+        y, mo, d, wd, h, mi, s, sub = RTC.dt
+        now = datetime.datetime(y, mo, d, h, mi, s) + datetime.timedelta(milliseconds = Board.clockMs - RTC.setMs)
+        return (now.year, now.month, now.day, now.weekday(), now.hour, now.minute, now.second, 0)
+
+
+def advance(ms):
+    end = Board.clockMs + ms
+    # wheel edges interrupt whatever is running
+    while Board.wheelNext is not None and Board.wheelNext <= end:
+        Board.clockMs = Board.wheelNext
+        pin = Pin(Board.WHEEL_PIN)
+        if Board.levels[Board.WHEEL_PIN]:
+            pin.drive(0)
+            Board.wheelNext += Board.wheelContact
+        else:
+            pin.drive(1)
+            Board.wheelNext = None if Board.wheelPeriod is None else Board.wheelNext + Board.wheelPeriod - Board.wheelContact
+    Board.clockMs = end
+    if Board.busyUntil is not None and Board.busyUntil <= Board.clockMs:
+        Board.busyUntil = None
+        Pin(Board.BUSY_PIN).drive(0)
+
+
+def idle():
+    advance(1)
+
+
+class Halt(BaseException):
+    # ends a run inside the script's main loop; BaseException so that the script's
+    # except Exception handlers let it through
+    pass
+
+
+def nextTimer():
+    due = [t for t in Board.timers if t.due is not None]
+    return min(due, key = lambda t: t.due) if due else None
+
+
+def lightsleep(ms = None):
+    # sleeps until ms have passed, a wheel edge or a Timer wakes the board, or the run ends
+    if Board.haltMs is not None and Board.haltMs <= Board.clockMs:
+        raise Halt()
+    end = Board.clockMs + ms if ms is not None else Board.haltMs
+    if Board.haltMs is not None:
+        end = min(end, Board.haltMs)
+    start = Board.clockMs
+    timer = nextTimer()
+    if timer is not None and timer.due < end:
+        end = max(Board.clockMs, timer.due)
+    if Board.wheelNext is not None and Board.wheelNext < end:
+        end = Board.wheelNext
+        timer = None
+    if Board.clockMs < end:
+        advance(end - Board.clockMs)
+    Board.sleepMs += Board.clockMs - start
+    Board.wakeups += 1
+    if timer is not None and timer.due <= Board.clockMs:
+        timer.fire()
+    runScheduled()
+
+
+def ticks_ms():
+    return Board.clockMs & 0x3fffffff
+
+
+def ticks_us():
+    return (Board.clockMs * 1000) & 0x3fffffff
+
+
+def mktime(t):
+    # MicroPython flavour: (year, month, mday, hour, minute, second, weekday, yearday), no time zone
+    return calendar.timegm((t[0], t[1], t[2], t[3], t[4], t[5], 0, 0, 0))
+
+
+def localtime(secs = None):
+    if secs is None:
+        dt = RTC().datetime()
+        secs = mktime((dt[0], dt[1], dt[2], dt[4], dt[5], dt[6], 0, 0))
+    t = _time.gmtime(secs)
+    return (t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, t.tm_wday, t.tm_yday)
+
+
+def ticks_diff(a, b):
+    return ((a - b + 0x20000000) & 0x3fffffff) - 0x20000000
+
+
+def ticks_add(a, b):
+    return (a + b) & 0x3fffffff
+
+
+def sleep(s):
+    advance(int(s * 1000))
+
+
+def sleep_ms(ms):
+    advance(ms)
+
+
+def sleep_us(us):
+    advance(us // 1000)
+
+
+def schedule(callback, arg):
+    if Board.scheduleDepth <= len(Board.scheduled):
+        raise RuntimeError('schedule queue full')
+    Board.scheduled.append([callback, arg])
+
+
+def runScheduled():
+    # what the VM does between bytecodes on the board
+    while Board.scheduled:
+        callback, arg = Board.scheduled.pop(0)
+        callback(arg)
+
+
+def wheel(period, contact = 20):
+    # period: ms per revolution, or None to stop after the current pass
+    Board.wheelPeriod = period
+    Board.wheelContact = contact
+    if period is not None and Board.wheelNext is None:
+        Board.wheelNext = Board.clockMs + period
+
+
+def run(ms):
+    # runs the board for ms of virtual time
+    if Board.mainLoop is not None:
+        Board.haltMs = Board.clockMs + ms
+        try:
+            Board.mainLoop()
+        except Halt:
+            pass
+        Board.haltMs = None
+        return
+
+    # no main loop: the board is idle between callbacks, so scheduled callbacks run as soon
+    # as a wheel edge queues them, and Timer callbacks fire in order of their due time.
+    # A callback that overruns delays whatever falls due meanwhile.
+    end = Board.clockMs + ms
+    while True:
+        runScheduled()
+        timer = nextTimer()
+        until = end if timer is None else min(end, timer.due)
+        if Board.wheelNext is not None and Board.wheelNext < until:
+            advance(Board.wheelNext - Board.clockMs)
+            continue
+        if Board.clockMs < until:
+            advance(until - Board.clockMs)
+        if timer is None or end < timer.due:
+            break
+        timer.fire()
+    runScheduled()
+
+
+class PowerLoss(BaseException):
+    # raised from a write once Board.writeBudget bytes have been written
+    pass
+
+
+class CountingFile():
+
+    # wraps a real file and counts the bytes that go through it on Board
+
+    def __init__(self, f):
+        self.f = f
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.f.close()
+
+    def __iter__(self):
+        for line in self.f:
+            Board.fileRead += len(line)
+            yield line
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def read(self, *args):
+        data = self.f.read(*args)
+        Board.fileRead += len(data)
+        return data
+
+    def readline(self, *args):
+        data = self.f.readline(*args)
+        Board.fileRead += len(data)
+        return data
+
+    def readinto(self, buf):
+        n = self.f.readinto(buf)
+        Board.fileRead += n or 0
+        return n
+
+    def write(self, data):
+        if Board.writeBudget is not None:
+            size = len(data) if isinstance(data, str) else memoryview(data).nbytes
+            if Board.writeBudget < size:
+                # the power goes down part way through this write
+                self.f.write(data[:Board.writeBudget] if isinstance(data, str) else bytes(memoryview(data).cast('B')[:Board.writeBudget]))
+                Board.fileWritten += Board.writeBudget
+                Board.writeBudget = 0
+                self.f.close()
+                raise PowerLoss()
+            Board.writeBudget -= size
+        n = self.f.write(data)
+        Board.fileWritten += n
+        return n
+
+
+def countingOpen(*args, **kwargs):
+    Board.fileOpens += 1
+    return CountingFile(builtins.open(*args, **kwargs))
+
+
+def runScript(path, mainLoop = 'scheduler'):
+    # boots a script as __main__ with counted file I/O and returns its globals. The boot ends
+    # at the first lightsleep() of the main loop, which run() resumes through g[mainLoop].run().
+    g = {'__name__': '__main__', '__file__': path, '__builtins__': builtins, 'open': countingOpen}
+    with open(path) as fp:
+        code = compile(fp.read(), path, 'exec')
+    Board.haltMs = Board.clockMs
+    try:
+        exec(code, g)
+    except Halt:
+        Board.mainLoop = g[mainLoop].run
+    Board.haltMs = None
+    return g
+
+
+def _module(name, **attrs):
+    m = types.ModuleType(name)
+    for k, v in attrs.items():
+        setattr(m, k, v)
+    return m
+
+
+def install():
+    import hostfb
+
+    Board.reset()
+
+    clock = dict(ticks_ms = ticks_ms, ticks_us = ticks_us, ticks_diff = ticks_diff, ticks_add = ticks_add,
+                 sleep = sleep, sleep_ms = sleep_ms, sleep_us = sleep_us, mktime = mktime, localtime = localtime,
+                 gmtime = localtime, time = lambda: mktime(localtime()))
+
+    sys.modules['machine'] = _module('machine', Pin = Pin, SPI = SPI, RTC = RTC, Timer = Timer, ADC = ADC, idle = idle,
+                                     lightsleep = lightsleep)
+    sys.modules['micropython'] = _module('micropython', schedule = schedule, const = lambda x: x,
+                                         alloc_emergency_exception_buf = lambda size: None)
+    sys.modules['rp2'] = _module('rp2', StateMachine = StateMachine, asm_pio = lambda **kwargs: (lambda program: program))
+    sys.modules['framebuf'] = hostfb
+    sys.modules['utime'] = _module('utime', **clock)
+
+    # 'time' is a builtin module on CPython, so the MicroPython flavoured one replaces it in sys.modules
+    t = _module('time', **{k: getattr(_time, k) for k in dir(_time) if not k.startswith('__')})
+    for k, v in clock.items():
+        setattr(t, k, v)
+    sys.modules['time'] = t
+
+    # gc.mem_free()/mem_alloc() report the tracemalloc figures while tracing, else a fixed heap
+    g = _module('gc', **{k: getattr(_gc, k) for k in dir(_gc) if not k.startswith('__')})
+    g.mem_alloc = lambda: tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+    g.mem_free = lambda: Board.heapSize - g.mem_alloc()
+    sys.modules['gc'] = g
@@ -1,10 +1,20 @@
-from machine import Pin, SPI, RTC, Timer
+from machine import Pin, SPI, RTC, Timer, ADC, idle, lightsleep
 import framebuf
 import utime
 import time
 import math
 import random
 import os
+import gc
+from array import array
+import struct
+import binascii
+import micropython
+import rp2
+
+bootTicks = time.ticks_ms()
+
+micropython.alloc_emergency_exception_buf(100)
 
 WF_PARTIAL_2IN13_V3= [
     0x0,0x40,0x0,0x0,0x0,0x0,0x0,0x0,0x0,0x0,0x0,0x0,
@@ -60,10 +70,17 @@ BUSY_PIN        = 13
 
 
 class EPD_2in13_V3_Landscape(framebuf.FrameBuffer):
+
+    bulkTransfer = True    # False: send the frame one byte per transaction as before
+    busyTimeout = 10000    # ms
+
     def __init__(self):
         self.reset_pin = Pin(RST_PIN, Pin.OUT)
         
         self.busy_pin = Pin(BUSY_PIN, Pin.IN, Pin.PULL_UP)
+        self.busyReleased = False
+        self.busyMs = {}       # ms spent waiting for BUSY, per phase
+        self.busy_pin.irq(self.busyFalling, Pin.IRQ_FALLING)
         self.cs_pin = Pin(CS_PIN, Pin.OUT)
         if EPD_WIDTH % 8 == 0:
             self.width = EPD_WIDTH
@@ -81,6 +98,28 @@ class EPD_2in13_V3_Landscape(framebuf.FrameBuffer):
 
         self.buffer = bytearray(self.height * self.width // 8)
         super().__init__(self.buffer, self.height, self.width, framebuf.MONO_VLSB)
+        self.ramPages = self.pages(self.buffer)     # self.buffer in 0x24/0x26 RAM order, no copy
+        self.blankPages = [b'\xff' * self.height] * (self.width // 8)
+        self.lastFrame = bytearray(len(self.buffer))    # what the panel RAM holds, for dirtyRegion()
+        self.lastFrameValid = False
+        self.oneByte = bytearray(1)     # reused by send_command() and send_data()
+        # page views of self.buffer and self.lastFrame, top to bottom, so that comparing them copies nothing
+        self.bufferViews = self.pageViews(self.buffer)
+        self.lastFrameViews = self.pageViews(self.lastFrame)
+
+        # what the controller currently holds, so unchanged registers and LUTs are not sent again
+        self.lut = None
+        self.registers = {}
+        # the registers that follow each LUT, built once so that switching LUTs allocates nothing
+        self.lutRegisters = {}
+        for lut in (self.full_lut, self.partial_lut):
+            self.lutRegisters[id(lut)] = ((0x3F, (lut[153],)),
+                                          (0x03, (lut[154],)),                      # gate voltage
+                                          (0x04, (lut[155], lut[156], lut[157])),   # source voltage VSH, VSH2, VSL
+                                          (0x2C, (lut[158],)))                      # VCOM
+        self.window = array('H', (0, 0, 0, 0)) # the last RAM window sent, see SetWindows()
+        self.asleep = True
+        self.resetStats()
         self.init()
 
     def digital_write(self, pin, value):
@@ -90,10 +129,11 @@ class EPD_2in13_V3_Landscape(framebuf.FrameBuffer):
         return pin.value()
 
     def delay_ms(self, delaytime):
-        utime.sleep(delaytime / 1000.0)
+        utime.sleep_ms(delaytime)
 
     def spi_writebyte(self, data):
-        self.spi.write(bytearray(data))
+        self.oneByte[0] = data
+        self.spi.write(self.oneByte)
 
     def reset(self):
         self.digital_write(self.reset_pin, 1)
@@ -102,67 +142,178 @@ class EPD_2in13_V3_Landscape(framebuf.FrameBuffer):
         self.delay_ms(2)
         self.digital_write(self.reset_pin, 1)
         self.delay_ms(20)   
+        self.forget()
+
+    def forget(self):
+        self.lut = None
+        self.registers.clear()
+        self.asleep = False
+
+    def resetStats(self):
+        self.commandCount = 0
+        self.dataCount = 0
+        self.busyMs.clear()
 
     def send_command(self, command):
+        self.busyReleased = False
+        self.commandCount += 1
         self.digital_write(self.dc_pin, 0)
         self.digital_write(self.cs_pin, 0)
-        self.spi_writebyte([command])
+        self.spi_writebyte(command)
         self.digital_write(self.cs_pin, 1)
 
     def send_data(self, data):
+        self.dataCount += 1
+        self.digital_write(self.dc_pin, 1)
+        self.digital_write(self.cs_pin, 0)
+        self.spi_writebyte(data)
+        self.digital_write(self.cs_pin, 1)
+
+    def send_data_bulk(self, pages):
         self.digital_write(self.dc_pin, 1)
         self.digital_write(self.cs_pin, 0)
-        self.spi_writebyte([data])
+        for p in pages:
+            self.spi.write(p)
+            self.dataCount += len(p)
         self.digital_write(self.cs_pin, 1)
 
-    def ReadBusy(self):
+    def send_register(self, command, data):
+        # skip the write when the controller already holds these values
+        if self.registers.get(command) == data:
+            return
+        self.send_command(command)
+        for d in data:
+            self.send_data(d)
+        self.registers[command] = data
+
+    def pages(self, image):
+        # the controller takes the pages of the landscape framebuffer bottom to top
+        mv = memoryview(image)
+        return [mv[j * self.height:(j + 1) * self.height] for j in range(self.width // 8 - 1, -1, -1)]
+
+    def write_ram(self, command, image):
+        self.send_command(command)
+        if self.bulkTransfer:
+            self.send_data_bulk(self.ramPages if image is self.buffer else self.pages(image))
+        else:
+            for j in range(int(self.width / 8) - 1, -1, -1):
+                for i in range(0, self.height):
+                    self.send_data(image[i + j * self.height])
+
+    def pageViews(self, image):
+        mv = memoryview(image)
+        return [mv[j * self.height:(j + 1) * self.height] for j in range(self.width // 8)]
+
+    def write_window(self, command, image, region):
+        Pstart, Pend, Cstart, Cend = region
+        mv = memoryview(image)
+        self.send_command(command)
+        self.digital_write(self.dc_pin, 1)
+        self.digital_write(self.cs_pin, 0)
+        for j in range(Pend, Pstart - 1, -1):
+            self.spi.write(mv[j * self.height + Cstart:j * self.height + Cend + 1])
+            self.dataCount += Cend + 1 - Cstart
+        self.digital_write(self.cs_pin, 1)
+
+    def columnChanged(self, image, c, Pstart, Pend):
+        for j in range(Pstart, Pend + 1):
+            if image[j * self.height + c] != self.lastFrame[j * self.height + c]:
+                return True
+        return False
+
+    def dirtyRegion(self, image):
+        # (first page, last page, first column, last column) of image that differs from the panel, or None
+        pages = self.width // 8
+        if not self.lastFrameValid:
+            return (0, pages - 1, 0, self.height - 1)
+
+        views = self.bufferViews if image is self.buffer else self.pageViews(image)
+        Pstart = 0
+        while Pstart < pages and views[Pstart] == self.lastFrameViews[Pstart]:
+            Pstart += 1
+        if Pstart == pages:
+            return None
+        Pend = pages - 1
+        while views[Pend] == self.lastFrameViews[Pend]:
+            Pend -= 1
+
+        Cstart = 0
+        while not self.columnChanged(image, Cstart, Pstart, Pend):
+            Cstart += 1
+        Cend = self.height - 1
+        while not self.columnChanged(image, Cend, Pstart, Pend):
+            Cend -= 1
+
+        return (Pstart, Pend, Cstart, Cend)
+
+    def sent(self, image):
+        self.lastFrame[:] = image
+        self.lastFrameValid = True
+
+    def busyFalling(self, pin):
+        self.busyReleased = True
+
+    def ReadBusy(self, phase = 'busy'):
         print('busy')
-        self.delay_ms(10)
-        while(self.digital_read(self.busy_pin) == 1):      # 0: idle, 1: busy
-            self.delay_ms(10)    
+        start = time.ticks_ms()
+        # sleep until the falling edge of BUSY wakes us up instead of polling every 10 ms
+        while not self.busyReleased and self.digital_read(self.busy_pin) == 1:      # 0: idle, 1: busy
+            if EPD_2in13_V3_Landscape.busyTimeout < time.ticks_diff(time.ticks_ms(), start):
+                print('ReadBusy()', phase, 'timeout.')
+                break
+            idle()
+        self.busyReleased = False
+        self.busyMs[phase] = self.busyMs.get(phase, 0) + time.ticks_diff(time.ticks_ms(), start)
         print('busy release')
 
     def TurnOnDisplay(self):
         self.send_command(0x22)  # Display Update Control
         self.send_data(0xC7)
         self.send_command(0x20)  #  Activate Display Update Sequence    
-        self.ReadBusy()
+        self.ReadBusy('refresh')
 
     def TurnOnDisplayPart(self):
         self.send_command(0x22)  # Display Update Control
         self.send_data(0x0F)     # fast:0x0c, quality:0x0f, 0xcf
         self.send_command(0x20)  # Activate Display Update Sequence 
-        self.ReadBusy()
+        self.ReadBusy('refreshPart')
 
     def LUT(self, lut):
         self.send_command(0x32)
         for i in range(0,153):
             self.send_data(lut[i])
-        self.ReadBusy()
+        self.ReadBusy('lut')
 
     def LUT_by_host(self, lut):
+        if self.lut is lut:
+            return
         self.LUT(lut)             # lut
-        self.send_command(0x3F)
-        self.send_data(lut[153])
-        self.send_command(0x03)   # gate voltage
-        self.send_data(lut[154])
-        self.send_command(0x04)   # source voltage
-        self.send_data(lut[155])  # VSH
-        self.send_data(lut[156])  # VSH2
-        self.send_data(lut[157])  # VSL
-        self.send_command(0x2C)   # VCOM
-        self.send_data(lut[158])
+        for command, data in self.lutRegisters[id(lut)]:
+            self.send_register(command, data)
+        self.lut = lut
 
     def SetWindows(self, Xstart, Ystart, Xend, Yend):
-        self.send_command(0x44)                #  SET_RAM_X_ADDRESS_START_END_POSITION
-        self.send_data((Xstart >> 3) & 0xFF)
-        self.send_data((Xend >> 3) & 0xFF)
-        
-        self.send_command(0x45)                #  SET_RAM_Y_ADDRESS_START_END_POSITION
-        self.send_data(Ystart & 0xFF)
-        self.send_data((Ystart >> 8) & 0xFF)
-        self.send_data(Yend & 0xFF)
-        self.send_data((Yend >> 8) & 0xFF)
+        # called on every refresh, so the window is compared with the last one sent instead of
+        # building value tuples for send_register(). forget() empties registers, which sends both again.
+        w = self.window
+        if 0x44 not in self.registers or w[0] != Xstart or w[2] != Xend:
+            #  SET_RAM_X_ADDRESS_START_END_POSITION
+            self.send_command(0x44)
+            self.send_data((Xstart >> 3) & 0xFF)
+            self.send_data((Xend >> 3) & 0xFF)
+            w[0] = Xstart
+            w[2] = Xend
+            self.registers[0x44] = w
+        if 0x45 not in self.registers or w[1] != Ystart or w[3] != Yend:
+            #  SET_RAM_Y_ADDRESS_START_END_POSITION
+            self.send_command(0x45)
+            self.send_data(Ystart & 0xFF)
+            self.send_data((Ystart >> 8) & 0xFF)
+            self.send_data(Yend & 0xFF)
+            self.send_data((Yend >> 8) & 0xFF)
+            w[1] = Ystart
+            w[3] = Yend
+            self.registers[0x45] = w
 
     def SetCursor(self, Xstart, Ystart):
         self.send_command(0x4E)             #  SET_RAM_X_ADDRESS_COUNTER
@@ -177,112 +328,120 @@ class EPD_2in13_V3_Landscape(framebuf.FrameBuffer):
         self.reset()
         self.delay_ms(100)
         
-        self.ReadBusy()
+        self.ReadBusy('reset')
         self.send_command(0x12)  # SWRESET
-        self.ReadBusy()
-        
-        self.send_command(0x01)  # Driver output control 
-        self.send_data(0xf9)
-        self.send_data(0x00)
-        self.send_data(0x00)
+        self.ReadBusy('swreset')
+        self.forget()
         
-        self.send_command(0x11)  #data entry mode 
-        self.send_data(0x07)
+        self.configure()
+        self.LUT_by_host(self.partial_lut)
+
+    def wake(self):
+        # Deep sleep mode 1 keeps the RAM, but the reset that ends it loses the registers and the LUT.
+        # SWRESET and the power-on delay are not needed, and the LUT is left to whichever refresh runs next.
+        if not self.asleep:
+            return
+        self.reset()
+        self.ReadBusy('reset')
+        self.configure()
+
+    def configure(self):
+        self.send_register(0x01, (0xf9, 0x00, 0x00))  # Driver output control 
+        self.send_register(0x11, (0x07,))  #data entry mode 
         
         self.SetWindows(0, 0, self.width-1, self.height-1)
         self.SetCursor(0, 0)
         
-        self.send_command(0x3C)  # BorderWavefrom
-        self.send_data(0x05)
-        
-        self.send_command(0x21) # Display update control
-        self.send_data(0x00)
-        self.send_data(0x80)
-        
-        self.send_command(0x18) # Read built-in temperature sensor
-        self.send_data(0x80)
+        self.send_register(0x3C, (0x05,))  # BorderWavefrom
+        self.send_register(0x21, (0x00, 0x80)) # Display update control
+        self.send_register(0x18, (0x80,)) # Read built-in temperature sensor
         
-        self.ReadBusy()
-        self.LUT_by_host(self.partial_lut)
+        self.ReadBusy('init')
 
     def Clear(self):
         self.send_command(0x24)
-        for j in range(int(self.width / 8) - 1, -1, -1):
-            for i in range(0, self.height):
-                self.send_data(0xFF)
+        if self.bulkTransfer:
+            self.send_data_bulk(self.blankPages)
+        else:
+            for j in range(int(self.width / 8) - 1, -1, -1):
+                for i in range(0, self.height):
+                    self.send_data(0xFF)
                 
         self.TurnOnDisplay()    
+        self.lastFrame[:] = b'\xff' * len(self.lastFrame)
+        self.lastFrameValid = True
 
     def display(self, image):
-        self.send_command(0x24)
-        for j in range(int(self.width / 8) - 1, -1, -1):
-            for i in range(0, self.height):
-                self.send_data(image[i + j * self.height])
-
+        self.LUT_by_host(self.partial_lut)
+        self.send_register(0x3C, (0x05,))
+        self.SetWindows(0, 0, self.width-1, self.height-1)
+        self.SetCursor(0, 0)
+        self.write_ram(0x24, image)
         self.TurnOnDisplay()
+        self.sent(image)
 
     def Display_Base(self, image):
-        self.send_command(0x24)
-        for j in range(int(self.width / 8) - 1, -1, -1):
-            for i in range(0, self.height):
-                self.send_data(image[i + j * self.height])
-                
-        self.send_command(0x26)
-        for j in range(int(self.width / 8) - 1, -1, -1):
-            for i in range(0, self.height):
-                self.send_data(image[i + j * self.height])
-                
+        self.LUT_by_host(self.partial_lut)
+        self.send_register(0x3C, (0x05,))
+        self.SetWindows(0, 0, self.width-1, self.height-1)
+        self.SetCursor(0, 0)
+        self.write_ram(0x24, image)
+        self.write_ram(0x26, image)
         self.TurnOnDisplay()
+        self.sent(image)
         
-    def display_Partial(self, image):
-        self.digital_write(self.reset_pin, 0)
-        self.delay_ms(1)
-        self.digital_write(self.reset_pin, 1)
-        
-        self.LUT_by_host(self.full_lut)
+    def display_Partial(self, image, region = None):
+        if self.lut is not self.full_lut:
+            if self.lut is not None:
+                # leaving the full refresh waveform, a reset just after wake() is not needed
+                self.digital_write(self.reset_pin, 0)
+                self.delay_ms(1)
+                self.digital_write(self.reset_pin, 1)
+                self.forget()
         
-        self.send_command(0x37)
-        self.send_data(0x00)
-        self.send_data(0x00)
-        self.send_data(0x00)
-        self.send_data(0x00)
-        self.send_data(0x00)
-        self.send_data(0x40)
-        self.send_data(0x00)
-        self.send_data(0x00)
-        self.send_data(0x00)
-        self.send_data(0x00)
-        self.send_data(0x00)
+            self.LUT_by_host(self.full_lut)
         
-        self.send_command(0x3C)
-        self.send_data(0x80)
+            self.send_register(0x37, (0x00, 0x00, 0x00, 0x00, 0x00, 0x40, 0x00, 0x00, 0x00, 0x00, 0x00))
+            self.send_register(0x3C, (0x80,))
         
-        self.send_command(0x22)
-        self.send_data(0xC0)
-        self.send_command(0x20)
-        self.ReadBusy()
+            self.send_command(0x22)
+            self.send_data(0xC0)
+            self.send_command(0x20)
+            self.ReadBusy('powerOn')
         
-        self.SetWindows(0,0,self.width-1,self.height-1)
-        self.SetCursor(0,0)
-        
-        self.send_command(0x24)
-        for j in range(int(self.width / 8) - 1, -1, -1):
-            for i in range(0, self.height):
-                self.send_data(image[i + j * self.height])
-                
+        if region is None:
+            self.SetWindows(0,0,self.width-1,self.height-1)
+            self.SetCursor(0,0)
+            self.write_ram(0x24, image)
+        else:
+            # RAM X runs over the landscape pages bottom to top, RAM Y over the columns
+            Pstart, Pend, Cstart, Cend = region
+            Xstart = self.width // 8 - 1 - Pend
+            Xend = self.width // 8 - 1 - Pstart
+            self.SetWindows(Xstart * 8, Cstart, Xend * 8, Cend)
+            self.SetCursor(Xstart, Cstart)
+            self.write_window(0x24, image, region)
+
         self.TurnOnDisplayPart()
+        self.sent(image)
     
     def sleep(self):
         self.send_command(0x10) #enter deep sleep
         self.send_data(0x01)
         self.delay_ms(100)
+        self.lut = None
+        self.registers.clear()
+        self.asleep = True
         
         
 class Environment():
     
     conversion_factor = 3.3 / (65535)    
+    sampleLength = 5 # 直近5分の平均をとる
+    burstLength = 16 # 1回の測定で続けて読む回数。16 * 65535 * 5でもsmall intに収まる
+    dayNames = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun') # RTC.datetime()[3]の曜日
     
-    def __init__(self, dt = None):
+    def __init__(self, scheduler, dt = None):
         
         self.rtc = RTC()
         if dt:
@@ -291,51 +450,287 @@ class Environment():
 
         self.dtTuple = self.rtc.datetime()
         
-        self.tempBuff = [0 for x in range(5)]
+        # 測定ごとのread_u16()の合計を整数のまま持ち、温度への換算はupdate()で1回だけ行う
+        self.adc = ADC(4)
+        self.sums = array('I', bytes(4 * Environment.sampleLength))
+        self.total = 0 # sumsの合計
+        self.count = 0 # sumsのうち測定済みのもの
         self.idx = -1
         self.measure(0)
+        self.tempValue = None
+        self.tempStr = None
         
-        self.timer = Timer()
-        self.timer.init(period = 1000 * 60, callback = self.measure) #1分ごと
+        scheduler.every(1000 * 60, self.measure, 'env') #1分ごと
         
     def measure(self, t):
 
-        self.idx = (self.idx + 1) % 5
-        
+        self.idx = (self.idx + 1) % Environment.sampleLength
+
+        # 続けて読んで足すだけ。ノイズは平均で減らす
+        s = 0
+        for i in range(Environment.burstLength):
+            s += self.adc.read_u16()
+
+        self.total += s - self.sums[self.idx]
+        self.sums[self.idx] = s
+        if self.count < Environment.sampleLength:
+            self.count += 1
+
+    def celsius(self):
+
         # The temperature sensor measures the Vbe voltage of a biased bipolar diode, connected to the fifth ADC channel
         # Typically, Vbe = 0.706V at 27 degrees C, with a slope of -1.721mV (0.001721) per degree. 
-        self.tempBuff[self.idx] = 27 - ((machine.ADC(4).read_u16() * Environment.conversion_factor) - 0.706) / 0.001721        
+        raw = self.total / (self.count * Environment.burstLength)
+        return 27 - ((raw * Environment.conversion_factor) - 0.706) / 0.001721
             
     def update(self):
 
-        t = [x for x in self.tempBuff if 0 < x]
-        self.tempValue = round(sum(t) / len(t), 1)
-
-        t = str(self.tempValue)
-        self.tempStr = t + ('' if '.' in t else '.0') + 'C'
+        value = round(self.celsius(), 1) if self.count else -1
+        if value <= 0:
+            value = -1
+        # 表示は0.1度単位なので、値が変わったときだけ文字列を作り直す
+        if value != self.tempValue:
+            self.tempValue = value
+            self.tempStr = '%.1fC' % value if 0 < value else '-C'
 
         self.dtTuple = self.rtc.datetime()
 
-        day = ''
-        if self.dtTuple[3] == 0:
-            day = 'Mon'
-        elif self.dtTuple[3] == 1:
-            day = 'Tue'
-        elif self.dtTuple[3] == 2:
-            day = 'Wed'
-        elif self.dtTuple[3] == 3:
-            day = 'Thu'
-        elif self.dtTuple[3] == 4:
-            day = 'Fri'
-        elif self.dtTuple[3] == 5:
-            day = 'Sat'
-        elif self.dtTuple[3] == 6:
-            day = 'Sun'
-
-        dt = [('0' if len(str(x)) < 2 else '') + str(x) for x in self.dtTuple]        
-        self.dtStr = dt[0] + '-' + dt[1] + '-' + dt[2] + ' ' + day + ' ' + dt[4] + ':' + dt[5] + ':' + dt[6]
+        # 途中の文字列を作らないように1回の%で整形する
+        dt = self.dtTuple
+        self.dtStr = '%d-%02d-%02d %s %02d:%02d:%02d' % (dt[0], dt[1], dt[2], Environment.dayNames[dt[3]], dt[4], dt[5], dt[6])
     
     
+class FixedArray():
+
+    # 0.1単位の固定小数点でarray('H')に格納し、読み書きはfloatで行う。0以下は無効値として0を入れる。
+    # floatのlistだと1件ごとにヒープ上にオブジェクトができるので、長いログはこちらに持つ。
+
+    def __init__(self, length, scale = 10):
+        self.raw = array('H', bytes(2 * length))
+        self.scale = scale
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, i):
+        return self.raw[i] / self.scale
+
+    def __setitem__(self, i, value):
+        self.raw[i] = round(self.scale * value) if 0 < value else 0
+
+    def __iter__(self):
+        for x in self.raw:
+            yield x / self.scale
+
+
+class WindowStats():
+
+    # 最後のlength個の値のうち正のもの(有効値)の数と最小・最大を保つ。
+    # 最小と最大は値の位置を並べた単調キューで持つので、1件ごとの更新は償却O(1)。
+
+    def __init__(self, length):
+        self.length = length
+        self.values = array('H', bytes(2 * length))
+        self.minQueue = array('H', bytes(2 * length))
+        self.maxQueue = array('H', bytes(2 * length))
+        self.clear()
+
+    def clear(self):
+        for i in range(self.length):
+            self.values[i] = 0
+        self.pos = 0
+        self.count = 0
+        self.minHead = 0
+        self.minLength = 0
+        self.maxHead = 0
+        self.maxLength = 0
+
+    def push(self, v):
+
+        i = self.pos
+        n = self.length
+
+        # 上書きされる一番古い値がキューに残っていれば先頭にある
+        if 0 < self.values[i]:
+            self.count -= 1
+        if self.minLength and self.minQueue[self.minHead] == i:
+            self.minHead = (self.minHead + 1) % n
+            self.minLength -= 1
+        if self.maxLength and self.maxQueue[self.maxHead] == i:
+            self.maxHead = (self.maxHead + 1) % n
+            self.maxLength -= 1
+
+        self.values[i] = v
+        if 0 < v:
+            self.count += 1
+            while self.minLength and v <= self.values[self.minQueue[(self.minHead + self.minLength - 1) % n]]:
+                self.minLength -= 1
+            self.minQueue[(self.minHead + self.minLength) % n] = i
+            self.minLength += 1
+            while self.maxLength and self.values[self.maxQueue[(self.maxHead + self.maxLength - 1) % n]] <= v:
+                self.maxLength -= 1
+            self.maxQueue[(self.maxHead + self.maxLength) % n] = i
+            self.maxLength += 1
+
+        self.pos = (i + 1) % n
+
+    def min(self):
+        return self.values[self.minQueue[self.minHead]] if self.minLength else 0
+
+    def max(self):
+        return self.values[self.maxQueue[self.maxHead]] if self.maxLength else 0
+
+
+class Tier():
+
+    # 下の段の記録をfactor件ずつまとめた1件を、length件のリングに持つ。
+    # 1件は距離の合計[m]と温度(0.1度単位、0は無効)の最小・最大・平均。まとめている途中の1件も持つ。
+    # ファイルの中ではoffsetから ヘッダ, 距離 float32 x length, 最小, 最大, 平均 uint16 x length の順に置く。
+
+    headerFormat = '<4sHHfIHHH' # magic, 最新のインデックス, まとめた件数, 途中の距離, 温度の合計, 件数, 最小, 最大
+    headerSize = struct.calcsize(headerFormat)
+
+    def __init__(self, magic, length, factor, offset):
+
+        self.magic = magic
+        self.length = length
+        self.factor = factor
+        self.offset = offset
+        self.size = Tier.headerSize + 10 * length
+        self.distance = array('f', bytes(4 * length))
+        self.tempMin = array('H', bytes(2 * length))
+        self.tempMax = array('H', bytes(2 * length))
+        self.tempMean = array('H', bytes(2 * length))
+        self.headerBuffer = bytearray(Tier.headerSize) # header()で毎回詰め直して使う
+        self.clear()
+
+    def clear(self):
+        for a in (self.distance, self.tempMin, self.tempMax, self.tempMean):
+            for i in range(self.length):
+                a[i] = 0
+        self.currentIndex = -1
+        self.sum = 0.0 # リング全体の距離の合計
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.distAcc = 0.0
+        self.tempSum = 0
+        self.tempCount = 0
+        self.minAcc = 0
+        self.maxAcc = 0
+
+    def push(self, dist, tMin, tMax, tMean):
+
+        # 1件まとまったらTrueを返す。呼び出し側はlatest()を次の段に渡す
+        self.distAcc += dist
+        if tMean:
+            self.tempSum += tMean
+            self.tempCount += 1
+            self.minAcc = tMin if self.minAcc == 0 or tMin < self.minAcc else self.minAcc
+            self.maxAcc = max(self.maxAcc, tMax)
+        self.count += 1
+        if self.count < self.factor:
+            return False
+
+        i = (self.currentIndex + 1) % self.length
+        self.currentIndex = i
+        leaving = self.distance[i]
+        self.distance[i] = self.distAcc
+        self.sum += self.distance[i] - leaving # float32に丸めた値で合計をとる
+        self.tempMin[i] = self.minAcc
+        self.tempMax[i] = self.maxAcc
+        self.tempMean[i] = (self.tempSum + self.tempCount // 2) // self.tempCount if self.tempCount else 0
+        self.reset()
+        if i == 0:
+            self.sum = sum(self.distance) # 一周ごとに誤差を捨てる
+        return True
+
+    def closeEmpty(self, n):
+        # 空の記録をn件まとめて閉じる。まとめている途中の1件がない(count == 0)ときに使う
+        if self.length <= n:
+            for a in (self.distance, self.tempMin, self.tempMax, self.tempMean):
+                for i in range(self.length):
+                    a[i] = 0
+            self.sum = 0.0
+            self.currentIndex = (self.currentIndex + n) % self.length
+            return
+
+        for k in range(n):
+            i = (self.currentIndex + 1) % self.length
+            self.currentIndex = i
+            self.sum -= self.distance[i]
+            self.distance[i] = 0
+            self.tempMin[i] = 0
+            self.tempMax[i] = 0
+            self.tempMean[i] = 0
+
+    def latest(self, k = 0):
+        # k件前の (距離, 最小, 最大, 平均)
+        i = (self.currentIndex - k) % self.length
+        return self.distance[i], self.tempMin[i], self.tempMax[i], self.tempMean[i]
+
+    def total(self, n):
+        # 最新n件の距離の合計。リング全体ならpush()で保っている合計をそのまま返す
+        if self.length <= n:
+            return self.sum
+        return sum(self.distance[(self.currentIndex - k) % self.length] for k in range(n))
+
+    def tempRange(self, n):
+        # 最新n件の温度の最小と最大。有効な温度がなければ(0, 0)
+        lower = 0
+        upper = 0
+        for k in range(n):
+            i = (self.currentIndex - k) % self.length
+            if self.tempMean[i]:
+                lower = self.tempMin[i] if lower == 0 or self.tempMin[i] < lower else lower
+                upper = max(upper, self.tempMax[i])
+        return lower, upper
+
+    def header(self):
+        struct.pack_into(Tier.headerFormat, self.headerBuffer, 0, self.magic, self.currentIndex % self.length, self.count, self.distAcc, self.tempSum, self.tempCount, self.minAcc, self.maxAcc)
+        return self.headerBuffer
+
+    def load(self, fp):
+        fp.seek(self.offset)
+        magic, index, count, self.distAcc, self.tempSum, self.tempCount, self.minAcc, self.maxAcc = struct.unpack(Tier.headerFormat, fp.read(Tier.headerSize))
+        if magic != self.magic or self.length <= index or self.factor <= count:
+            raise ValueError('unknown format')
+        for a in (self.distance, self.tempMin, self.tempMax, self.tempMean):
+            if fp.readinto(a) != a.itemsize * self.length:
+                raise ValueError('truncated')
+        self.currentIndex = index
+        self.count = count
+        self.sum = sum(self.distance)
+
+    def saveAll(self, fp):
+        fp.seek(self.offset)
+        n = fp.write(self.header())
+        for a in (self.distance, self.tempMin, self.tempMax, self.tempMean):
+            n += fp.write(a)
+        return n
+
+    def save(self, fp, closed):
+        # まとまった1件があればそれを書いてから、途中の1件を含むヘッダを書く
+        n = 0
+        if closed:
+            i = self.currentIndex
+            fp.seek(self.offset + Tier.headerSize + 4 * i)
+            n += fp.write(struct.pack('<f', self.distance[i]))
+            for k, a in enumerate((self.tempMin, self.tempMax, self.tempMean)):
+                fp.seek(self.offset + Tier.headerSize + (4 + 2 * k) * self.length + 2 * i)
+                n += fp.write(struct.pack('<H', a[i]))
+        fp.seek(self.offset)
+        n += fp.write(self.header())
+        return n
+
+    def dump(self, n):
+        # REPLから logger.hourly.dump(24) などで見る。古い順に n件
+        for k in range(n - 1, -1, -1):
+            dist, lower, upper, mean = self.latest(k)
+            print('%8.1fm %5.1fC %5.1fC %5.1fC' % (dist, lower / 10, upper / 10, mean / 10))
+
+
 class Logger():
     
     # 5分ごとの記録を１単位にする
@@ -346,95 +741,329 @@ class Logger():
     dayLength = int(24 * 60 / 5)
     halfDayLength = int(12 * 60 / 5)
     displayLength = int(18 * 60 / 5)
+    resyncInterval = dayLength # 浮動小数点の誤差がたまらないように1日ごとに合計を計算し直す
     
-    logFileName = 'history.log'
-    falseRestore = True
+    # 5分ごとの記録を1時間ごと(3か月分)と1日ごと(3年分)にまとめた段。tierFileに続けて置く
+    # 1時間 2208件 x 10バイト + 1日 1098件 x 10バイトで、RAMもファイルも約33KBで頭打ちになる
+    hourlyLength = 92 * 24
+    dailyLength = 3 * 366
+    tierFile = 'tiers.bin'
+
+    # 毎回別名に丸ごと書いてから置き換えるので、電源が落ちても前回か今回のどちらかが残る
+    # header: magic(形式の版), 最後に記録した時刻(mktimeの秒), 最新のインデックス, 距離と温度のCRC32
+    # 距離: float32 x weekLength, 温度: uint16(0.1度単位, 0は無効) x weekLength
+    historyFile = 'history.bin'
+    historyTempFile = 'history.bin.tmp'
+    historyMagic = b'HUM3'
+    headerFormat = '<4sIHI'
+    headerSize = struct.calcsize(headerFormat)
+    slotSeconds = 5 * 60
+
+    logFileName = 'history.log' # 旧形式のテキストログ。起動時にhistoryFileへ移行する
     
     def __init__(self, wakeupDT, env, dummy = False):
         
+        start = time.ticks_ms()
+        self.bytesWritten = 0 # historyFileに書いたバイト数
+        self.headerBuffer = bytearray(Logger.headerSize) # save()で毎回詰め直して使う
+        self.tempStats = WindowStats(Logger.displayLength) # グラフに出す温度の数・最小・最大
+        self.clear()
+
+        gap = 0 # 止まっていて記録できなかった5分枠の数
         if dummy: #テスト用
-            self.temp = [random.uniform(19, 24) for x in range(Logger.weekLength)]
-            self.distance = [random.uniform(0, 10) for x in range(Logger.weekLength)]
-            self.currentIndex = -1
+            for i in range(Logger.weekLength):
+                self.temp[i] = random.uniform(19, 24)
+                self.distance[i] = random.uniform(0, 10)
 
         else:
-            self.temp = [0.0 for x in range(Logger.weekLength)]
-            self.distance = [0.0 for x in range(Logger.weekLength)]
-
-            if Logger.logFileName in os.listdir():
-                with open(Logger.logFileName, 'r') as fp:
-                    lastUpdateDT = [int(x) for x in fp.readline().split(',')]
-
-                    # wakeupDTとlastUpdateDTの差を見て、復旧するログのインデックスをいい感じに調整する。
-                    # めんどくさいので、日を跨いでOFFしていたら全て履歴を捨てて初めから測定する。同じ日のうちの再接続か過去にタイムトリップしたときだけ履歴を読む。
-                    if ''.join([str(x) for x in lastUpdateDT[:4]]) == ''.join([str(x) for x in wakeupDT[:4]]) or Logger.falseRestore:
-                        
-                        lastUpdateMin = (lastUpdateDT[4] * 60) + lastUpdateDT[5] + (lastUpdateDT[6] / 60)
-                        wakeupMin = (wakeupDT[4] * 60) + wakeupDT[5] + (wakeupDT[6] / 60)
-                        diffMin = wakeupMin - lastUpdateMin
-
-                        idx = 0
-                        for line in fp.readlines():
-                            self.temp[idx], self.distance[idx] = [float(x) for x in line.split(',')]
-                            idx += 1
-
-                        #起動した時間が過去にタイムスリップしていたら、とりあえず全ての履歴をそのまま復元する。
-                        #時間が経過していた時だけ、経過した分期間を空白で埋めてインデックスをずらす。
-                        if 0 < diffMin and (not Logger.falseRestore): 
-                            offsetIdx = round(diffMin / 5) % Logger.weekLength
-
-#                            print(lastUpdateDT)
-#                            print(wakeupDT)
-#                            print(diffMin, diffMin / 60)
-#                            print(offsetIdx)
-                            
-                            for i in range(offsetIdx):
-                                self.temp[i] = 0.0
-                                self.distance[i] = 0.0
-
-                            self.currentIndex = offsetIdx - 1
-
-                        else:
-                            env.rtc.datetime(lastUpdateDT) # restore last updated time if time didn't proceed
-                            time.sleep(0.1) # this seems needed to reflect dt in rtc
-                            self.currentIndex = -1
-
-                    else:
-                        self.currentIndex = -1
-            
-            else:
-                self.currentIndex = -1
+            lastUpdate = None
+            if Logger.historyFile in os.listdir():
+                try:
+                    lastUpdate = self.load()
+                except Exception as e:
+                    print('Logger.init()', Logger.historyFile, 'read failed.', e)
+                    self.clear()
+
+            elif Logger.logFileName in os.listdir():
+                try:
+                    lastUpdate = self.epoch(self.loadText())
+                    os.remove(Logger.logFileName)
+                except Exception as e:
+                    print('Logger.init()', Logger.logFileName, 'read failed.', e)
+                    self.clear()
+
+            if lastUpdate:
+                gap = self.restore(lastUpdate, self.epoch(wakeupDT), env)
+
+        self.hourly = Tier(b'HUMh', Logger.hourlyLength, 60 // 5, 0)
+        self.daily = Tier(b'HUMd', Logger.dailyLength, 24, self.hourly.size)
+        self.tiers = (self.hourly, self.daily)
+        self.loadTiers()
+        if 0 < gap:
+            self.skipTiers(gap)
+            self.saveTiers()
+            # 空にした最後の枠までを記録済みにしておく。次の記録の前にもう一度起動しても同じ枠を二度進めない
+            t = time.localtime(lastUpdate + gap * Logger.slotSeconds)
+            self.save((t[0], t[1], t[2], t[6], t[3], t[4], t[5], 0))
+
+        self.updateCount = 0
+        self.distLog = None
+        self.resync()
+        self.restoreMs = time.ticks_diff(time.ticks_ms(), start)
+
+    def clear(self):
+        self.temp = FixedArray(Logger.weekLength)
+        self.distance = array('f', bytes(4 * Logger.weekLength))
+        self.currentIndex = -1
+
+    def epoch(self, dt):
+        # RTCのタプル (年, 月, 日, 曜日, 時, 分, 秒, サブ秒) -> 秒
+        return time.mktime((dt[0], dt[1], dt[2], dt[4], dt[5], dt[6], 0, 0))
+
+    def restore(self, lastUpdate, wakeup, env):
+
+        # 時計が最後の記録より前なら、電源が落ちて時計が戻ったとみなして最後の記録の時刻から続ける
+        if wakeup < lastUpdate:
+            t = time.localtime(lastUpdate)
+            env.rtc.datetime((t[0], t[1], t[2], t[6], t[3], t[4], t[5], 0))
+            time.sleep(0.1) # this seems needed to reflect dt in rtc
+            return 0
+
+        # 止まっていた間の枠を空にしてインデックスを進める。起動直後のupdate()が次の枠に入る
+        gap = (wakeup - lastUpdate) // Logger.slotSeconds - 1
+        self.fastForward(gap)
+        return gap
+
+    def fastForward(self, gap):
+
+        if gap <= 0:
+            return
+        if Logger.weekLength <= gap:
+            self.clear()
+            return
+
+        # リングの末尾で折り返す分は2回に分けて、まとめて0を書く
+        start = self.currentIndex + 1
+        end = start + gap
+        for a, b in ((start, min(end, Logger.weekLength)), (0, end - Logger.weekLength)):
+            if a < b:
+                self.distance[a:b] = array('f', bytes(4 * (b - a)))
+                self.temp.raw[a:b] = array('H', bytes(2 * (b - a)))
+        self.currentIndex = (self.currentIndex + gap) % Logger.weekLength
+
+    def load(self):
+        with open(Logger.historyFile, 'rb') as fp:
+            magic, lastUpdate, index, crc = struct.unpack(Logger.headerFormat, fp.read(Logger.headerSize))
+            if magic != Logger.historyMagic:
+                raise ValueError('unknown format')
+            if fp.readinto(self.distance) != 4 * Logger.weekLength or fp.readinto(self.temp.raw) != 2 * Logger.weekLength:
+                raise ValueError('truncated')
+            if crc != self.checksum():
+                raise ValueError('checksum mismatch')
+
+        self.currentIndex = index
+        return lastUpdate
+
+    def loadText(self):
+        # 旧形式は1行目が日時、以降は古い順に 温度,距離 で、最後の行が最新
+        with open(Logger.logFileName, 'r') as fp:
+            lastUpdateDT = [int(x) for x in fp.readline().split(',')]
+
+            idx = 0
+            for line in fp.readlines():
+                self.temp[idx], self.distance[idx] = [float(x) for x in line.split(',')]
+                idx += 1
+
+        self.currentIndex = -1
+        return lastUpdateDT
+
+    def checksum(self):
+        return binascii.crc32(self.temp.raw, binascii.crc32(self.distance))
+
+    def save(self, dt):
+        try:
+            with open(Logger.historyTempFile, 'wb') as fp:
+                struct.pack_into(Logger.headerFormat, self.headerBuffer, 0, Logger.historyMagic, self.epoch(dt), self.currentIndex % Logger.weekLength, self.checksum())
+                self.bytesWritten += fp.write(self.headerBuffer)
+                self.bytesWritten += fp.write(self.distance)
+                self.bytesWritten += fp.write(self.temp.raw)
+            os.rename(Logger.historyTempFile, Logger.historyFile)
+        except Exception as e:
+            print('Logger.save()', Logger.historyFile, 'write failed.', e)
+
+    def loadTiers(self):
+        if Logger.tierFile in os.listdir():
+            try:
+                with open(Logger.tierFile, 'rb') as fp:
+                    for tier in self.tiers:
+                        tier.load(fp)
+                return
+            except Exception as e:
+                print('Logger.loadTiers()', Logger.tierFile, 'read failed.', e)
+
+        for tier in self.tiers:
+            tier.clear()
+        self.saveTiers()
+
+    def saveTiers(self):
+        try:
+            with open(Logger.tierFile, 'wb') as fp:
+                for tier in self.tiers:
+                    self.bytesWritten += tier.saveAll(fp)
+        except Exception as e:
+            print('Logger.saveTiers()', Logger.tierFile, 'write failed.', e)
+
+    def skipTiers(self, gap):
+        # 止まっていた間のgap枠を空の記録として段に入れ、段の区切りを時計とそろえる。
+        # 途中まで入っていた1時間と1日は空の記録で埋めて閉じ、その先はまるごと空の1件ずつ閉じるのでO(gap / 12)
+        hourly, daily = self.hourly, self.daily
+        while gap and hourly.count:
+            gap -= 1
+            if hourly.push(0.0, 0, 0, 0):
+                daily.push(*hourly.latest())
+
+        hours = gap // hourly.factor
+        hourly.closeEmpty(hours)
+        while hours and daily.count:
+            hours -= 1
+            daily.push(0.0, 0, 0, 0)
+        daily.closeEmpty(hours // daily.factor)
+        for k in range(hours % daily.factor):
+            daily.push(0.0, 0, 0, 0)
+
+        for k in range(gap % hourly.factor):
+            hourly.push(0.0, 0, 0, 0)
+
+    def rollUp(self, dist, temp):
+        # 5分の1件を1時間の段へ、1時間がまとまったら1日の段へ渡す
+        closed = 0
+        if self.hourly.push(dist, temp, temp, temp):
+            closed = 1
+            if self.daily.push(*self.hourly.latest()):
+                closed = 2
+
+        try:
+            with open(Logger.tierFile, 'r+b') as fp:
+                for k in range(len(self.tiers)):
+                    self.bytesWritten += self.tiers[k].save(fp, k < closed)
+        except Exception as e:
+            print('Logger.rollUp()', Logger.tierFile, 'write failed.', e)
+
+    def report(self):
+        # REPLから logger.report() で見る。段から長い期間の距離と温度の幅を出す
+        for name, tier, n in (('1d', self.hourly, 24), ('7d', self.hourly, 7 * 24), ('92d', self.hourly, Logger.hourlyLength),
+                              ('1y', self.daily, 365), ('3y', self.daily, Logger.dailyLength)):
+            lower, upper = tier.tempRange(n)
+            print('%-4s %10.1fm %5.1fC %5.1fC' % (name, tier.total(n), lower / 10, upper / 10))
+
+    def windowSum(self, length):
+        return sum((self.distance[(self.currentIndex - i) % Logger.weekLength] for i in range(length)))
+
+    def resync(self):
+        self.sumWeek = sum(self.distance)
+        self.sumDay = self.windowSum(Logger.dayLength)
+        self.sumHalfDay = self.windowSum(Logger.halfDayLength)
+        self.sumDisplay = self.windowSum(Logger.displayLength)
+
+        self.tempStats.clear()
+        for i in range(-1 * Logger.displayLength + 1, 1):
+            self.tempStats.push(self.temp.raw[(self.currentIndex + i) % Logger.weekLength])
 
     def update(self, tempValue, dt, distance):
         
         self.currentIndex = (self.currentIndex + 1) % Logger.weekLength
         self.temp[self.currentIndex] = tempValue
-        self.distance[self.currentIndex] = distance
-        
-        self.distanceWeek = round(sum([self.distance[(self.currentIndex - i) % Logger.weekLength] for i in range(Logger.weekLength)]) / 1000, 1)
-        self.distanceDay = round(sum([self.distance[(self.currentIndex - i) % Logger.weekLength] for i in range(Logger.dayLength)]))
-        self.distanceHalfDay = round(sum([self.distance[(self.currentIndex - i) % Logger.weekLength] for i in range(Logger.halfDayLength)]))
+        self.tempStats.push(self.temp.raw[self.currentIndex])
+
+        # 各区間の合計から、区間を抜けるサンプルを引いて新しいサンプルを足す
+        i = self.currentIndex
+        leaving = self.distance[i]
+        self.distance[i] = distance
+        distance = self.distance[i] # float32に丸めた値で合計をとる
+        self.sumWeek += distance - leaving
+        self.sumDay += distance - self.distance[(i - Logger.dayLength) % Logger.weekLength]
+        self.sumHalfDay += distance - self.distance[(i - Logger.halfDayLength) % Logger.weekLength]
+        self.sumDisplay += distance - self.distance[(i - Logger.displayLength) % Logger.weekLength]
+
+        self.updateCount += 1
+        if self.updateCount % Logger.resyncInterval == 0:
+            self.resync()
         
-        self.distLog = str(self.distanceWeek) + 'km/week ' + str(self.distanceDay) + 'm/day ' + str(self.distanceHalfDay) + 'm/12h'
+        # 差分で更新した合計は誤差でわずかに負になることがあるので0で止める
+        distanceWeek = round(max(0.0, self.sumWeek) / 1000, 1)
+        distanceDay = round(max(0.0, self.sumDay))
+        distanceHalfDay = round(max(0.0, self.sumHalfDay))
 
-        with open(Logger.logFileName, 'w') as fp:
-            fp.write(','.join([str(x) for x in dt]) + '\n')
+        # 表示する値が変わったときだけ一度に整形し直す
+        if self.distLog is None or distanceWeek != self.distanceWeek or distanceDay != self.distanceDay or distanceHalfDay != self.distanceHalfDay:
+            self.distanceWeek = distanceWeek
+            self.distanceDay = distanceDay
+            self.distanceHalfDay = distanceHalfDay
+            self.distLog = '%.1fkm/week %dm/day %dm/12h' % (distanceWeek, distanceDay, distanceHalfDay)
+
+        self.save(dt)
+        self.rollUp(self.distance[i], self.temp.raw[self.currentIndex])
+
+@rp2.asm_pio()
+def pioEdgeCounter():
+    # X: 数えたエッジ数 (0から減らしていく)、Y: 次のirqまでのエッジ数 (OSRから読み直す)
+    # 落ちてから64クロック、戻ってから64クロックは入力を見ないのでチャタリングは数えない
+    set(x, 0)
+    pull()
+    mov(y, osr)
+    wrap_target()
+    wait(0, pin, 0)             # 磁石が来た
+    jmp(x_dec, 'counted')
+    label('counted')
+    jmp(y_dec, 'settle') [31]
+    mov(y, osr) [31]
+    irq(rel(0))                 # Yの回数ごとにPythonへ知らせる
+    label('settle')
+    nop() [31]
+    wait(1, pin, 0) [31]        # 磁石が離れた
+    nop() [31]
+    wrap()
 
-            idx = self.currentIndex + 1
-            for x in range(Logger.weekLength):
-                fp.write(','.join([str(self.temp[idx]), str(self.distance[idx])]) + '\n')
-                idx = (idx + 1) % Logger.weekLength
 
 class Counter():
     
     unit = math.pi * 0.16 #[m]    
+    TickQueueLength = 64 # IRQで記録して未処理のエッジの最大数
+    LedPulse = 200 # [ms]
+    PioFreq = 2000 # PIOのクロック[Hz]。64クロックで32ms
+
+    # デバウンスの間隔は回転周期の推定値の3/8にする
+    DebounceMin = 30 # [ms]
+    DebounceMax = 250 # [ms] 前の固定値。推定が遅れていても、周期がこれより長い回転は必ず数える
+    PeriodInit = 667 # 回り始めの周期の推定値[ms]。デバウンスは250ms
+    PeriodMax = 4000 # これより間隔が空いたら止まっていたとみなして推定をやり直す[ms]
+
+    HistogramBin = 20 # エッジ間隔の分布の幅[ms]
+    HistogramLength = 100 # 最後のビンは2秒以上の間隔をまとめて数える
     
-    def __init__(self):
+    def __init__(self, pio = False):
         
         self.lastTick = time.ticks_ms()        
         self.distance = 0.0
         self.led = Pin(25, Pin.OUT)
         
+        # IRQではエッジの時刻を記録するだけにして、残りはprocess()で処理する
+        self.ticks = array('I', bytes(4 * Counter.TickQueueLength))
+        self.tickHead = 0 # increment()だけが進める
+        self.tickTail = 0 # process()だけが進める
+        self.tickLost = 0 # キューが溢れて捨てたエッジの数
+        self.scheduled = False
+
+        self.period = Counter.PeriodInit # 回転周期の推定値[ms]
+        self.debounce = (Counter.PeriodInit * 3) >> 3
+        self.lastRevolution = self.lastTick
+        self.histogram = array('H', bytes(2 * Counter.HistogramLength))
+
+        # IRQの中で束縛メソッドを作らないように先に取っておく
+        self.processRef = self.process
+        self.ledOffRef = self.ledOff
+        self.ledTimer = Timer()
+        
         # 隣がたぶん接触しているのでGP4と一緒にpull upしておく
         Pin(2, Pin.IN, Pin.PULL_UP)
         Pin(3, Pin.IN, Pin.PULL_UP)
@@ -446,44 +1075,375 @@ class Counter():
         Pin(28, Pin.IN, Pin.PULL_DOWN)
         
         p4 = Pin(4, Pin.IN, Pin.PULL_UP)
-        p4.irq(self.increment, Pin.IRQ_FALLING)
+        if pio:
+            # PIOでエッジを数える。Pythonは数をprocess()で読むだけ
+            self.pioCount = 0
+            self.sm = rp2.StateMachine(0, pioEdgeCounter, freq = Counter.PioFreq, in_base = p4)
+            self.sm.put(-1) # 速度は出さない。Y=0だとエッジごとにirqが立つので、Yを最大(0xFFFFFFFF)にして2**32エッジに1回にする
+            self.sm.active(1)
+        else:
+            self.sm = None
+            p4.irq(self.increment, Pin.IRQ_FALLING, hard = True)
     
     def increment(self, pin):
         
-        diff = time.ticks_diff(time.ticks_ms(), self.lastTick)
-        self.lastTick = time.ticks_ms()
-        if diff < 250:
+        # hard IRQ: メモリ確保はできないので時刻をリングに入れてprocess()を予約するだけ
+        head = self.tickHead
+        nextHead = (head + 1) % Counter.TickQueueLength
+        if nextHead == self.tickTail:
+            self.tickLost += 1
             return
+
+        self.ticks[head] = time.ticks_ms()
+        self.tickHead = nextHead
+
+        if not self.scheduled:
+            self.scheduled = True
+            try:
+                micropython.schedule(self.processRef, 0)
+            except RuntimeError:
+                self.scheduled = False # 予約キューが一杯なら次のエッジかupdate()で処理する
+
+    def process(self, arg):
+
+        if self.sm:
+            # PIOのXを読み出す。Xは0から減らしているので符号を反転した値が累計
+            self.sm.exec('mov(isr, x)')
+            self.sm.exec('push()')
+            count = -self.sm.get() & 0xffffffff
+            self.distance += Counter.unit * ((count - self.pioCount) & 0xffffffff)
+            self.pioCount = count
+            return
+
+        self.scheduled = False
+        while self.tickTail != self.tickHead:
+            self.revolution(self.ticks[self.tickTail])
+            self.tickTail = (self.tickTail + 1) % Counter.TickQueueLength
+
+    def revolution(self, currentMS):
+        
+        diff = time.ticks_diff(currentMS, self.lastTick)
+        self.lastTick = currentMS
+
+        # エッジ間隔の分布。チャタリングで捨てるエッジも数える
+        b = min(diff // Counter.HistogramBin, Counter.HistogramLength - 1)
+        if self.histogram[b] < 0xffff:
+            self.histogram[b] += 1
+
+        # 最後に数えた回転から測る。捨てたエッジから測ると、急に速くなったときに全部捨て続ける
+        interval = time.ticks_diff(currentMS, self.lastRevolution)
+        if interval < self.debounce:
+            return
+
+        # 数えた回転の間隔で周期の推定を更新する
+        self.lastRevolution = currentMS
+        if interval < Counter.PeriodMax:
+            self.period += (interval - self.period) >> 2
+        else:
+            self.period = Counter.PeriodInit
+        self.debounce = max(Counter.DebounceMin, min(Counter.DebounceMax, (self.period * 3) >> 3))
         
         self.distance += Counter.unit
 #        print(self.distance)
 
-        self.led.value(1)            
-        time.sleep(0.2)
+        self.led.value(1)
+        self.ledTimer.init(mode = Timer.ONE_SHOT, period = Counter.LedPulse, callback = self.ledOffRef)
+
+    def ledOff(self, timer):
         self.led.value(0)
+
+    def dumpHistogram(self):
+
+        # REPLから counter.dumpHistogram() で見る。IRQモードだけ
+        print('Counter.dumpHistogram()', 'period', self.period, 'debounce', self.debounce)
+        for i in range(Counter.HistogramLength):
+            if self.histogram[i]:
+                upper = '%4d' % ((i + 1) * Counter.HistogramBin) if i < Counter.HistogramLength - 1 else '    '
+                print('%4d-' % (i * Counter.HistogramBin) + upper + 'ms', self.histogram[i])
         
         
+class TextCache():
+
+    # 描いた文字列のビットマップを覚えておき、次からはblitで貼るだけにする。
+    # 一杯になったら一番長く使われていないものを捨てる。
+
+    def __init__(self, size):
+
+        self.size = size
+        self.bitmaps = {} # 文字列 -> [FrameBuffer, 最後に使った回]
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+
+    def draw(self, fb, s, x, y):
+
+        if not s:
+            return
+
+        self.clock += 1
+        entry = self.bitmaps.get(s)
+        if entry is None:
+            self.misses += 1
+            if self.size <= len(self.bitmaps):
+                del self.bitmaps[min(self.bitmaps, key = lambda k: self.bitmaps[k][1])]
+
+            # 白地に黒で描いておき、白(1)を透過色にして貼る
+            bitmap = framebuf.FrameBuffer(bytearray(8 * len(s)), 8 * len(s), 8, framebuf.MONO_VLSB)
+            bitmap.fill(1)
+            bitmap.text(s, 0, 0, 0)
+            entry = [bitmap, 0]
+            self.bitmaps[s] = entry
+        else:
+            self.hits += 1
+
+        entry[1] = self.clock
+        fb.blit(entry[0], x, y, 1)
+
+
+class CycleStats():
+
+    # 更新1回ごとに、段階ごとの時間[us]と数えたものを固定長のリングに残す。
+    # REPLからctrl.stats.dump()で表示、ctrl.stats.save()でstatsFileに書き出す。
+
+    phases = ('env', 'counter', 'logger', 'wake', 'render', 'display', 'sleep', 'collect')
+    fields = phases + ('spiBytes', 'commands', 'busyMs', 'written', 'gc', 'free')
+    statsFile = 'stats.csv'
+
+    def __init__(self, length):
+
+        self.length = length
+        self.records = array('i', bytes(4 * length * len(CycleStats.fields)))
+        self.count = 0 # これまでに記録した回数
+        self.row = 0
+        self.start = 0
+        self.alloc = 0
+        self.collections = 0
+        self.written = 0
+
+    def begin(self, written):
+        
+        self.row = (self.count % self.length) * len(CycleStats.fields)
+        for i in range(len(CycleStats.fields)):
+            self.records[self.row + i] = 0
+        self.collections = 0
+        self.written = written
+        self.alloc = gc.mem_alloc()
+        self.start = time.ticks_us()
+
+    def mark(self, phase):
+
+        # 前のmark()からの時間をphaseに足す。gc.mem_alloc()にかかる時間は含めない
+        elapsed = time.ticks_diff(time.ticks_us(), self.start)
+        self.records[self.row + CycleStats.phases.index(phase)] += elapsed
+        alloc = gc.mem_alloc()
+        if alloc < self.alloc and phase != 'collect': # 確保量が減るのはGCが走ったときだけ。update()の最後のgc.collect()は数えない
+            self.collections += 1
+        self.alloc = alloc
+        self.start = time.ticks_us()
+
+    def end(self, epd, written):
+
+        i = self.row + len(CycleStats.phases)
+        self.records[i] = epd.commandCount + epd.dataCount
+        self.records[i + 1] = epd.commandCount
+        self.records[i + 2] = sum(epd.busyMs.values())
+        self.records[i + 3] = written - self.written
+        self.records[i + 4] = self.collections
+        self.records[i + 5] = gc.mem_free()
+        self.count += 1
+
+    def rows(self):
+        # 古い順
+        n = len(CycleStats.fields)
+        for k in range(max(0, self.count - self.length), self.count):
+            i = (k % self.length) * n
+            yield self.records[i:i + n]
+
+    def dump(self):
+        print(' '.join(CycleStats.fields))
+        for r in self.rows():
+            print(' '.join(str(v) for v in r))
+
+    def save(self):
+        try:
+            with open(CycleStats.statsFile, 'w') as fp:
+                fp.write(','.join(CycleStats.fields) + '\n')
+                for r in self.rows():
+                    fp.write(','.join(str(v) for v in r) + '\n')
+        except Exception as e:
+            print('CycleStats.save()', CycleStats.statsFile, 'write failed.', e)
+
+
+class Scheduler():
+
+    # 1分ごとの温度と5分ごとの更新を1つのループにまとめ、次の期限までlightsleepで眠る。
+    # 車輪のエッジ(GP4のIRQ)でも起きるので、そのときはエッジを数えてまた眠る。
+    # lightsleep中はUSBも止まるのでREPLを使うときはlightSleep = Falseにする。
+    # PIOで数えるときもPIOのクロックが止まるので眠らずに待つ。
+
+    def __init__(self, lightSleep = True):
+
+        self.lightSleep = lightSleep
+        self.tasks = [] # [次の期限(ticks_ms), 周期[ms], callback, 名前]
+        # 合計がsmall int (2**30)を超えると足すたびにヒープを使うので、msとsの単位で持って端数を持ち越す
+        self.awakeMs = {'wheel': 0} # 名前 -> 起きていた時間の合計[ms]。'wheel'はエッジで起きていた分
+        self.awakeCarry = {'wheel': 0} # 名前 -> awakeMsに入れていない端数[us]
+        self.wakeCount = {'wheel': 0}
+        self.sleepS = 0
+        self.sleepCarry = 0 # sleepSに入れていない端数[ms]
+        self.stepUs = 0
+
+    def every(self, period, callback, name):
+        self.tasks.append([time.ticks_add(time.ticks_ms(), period), period, callback, name])
+        self.awakeMs[name] = 0
+        self.awakeCarry[name] = 0
+        self.wakeCount[name] = 0
+
+    def due(self, name):
+        # 次に呼ぶまでの時間[ms]
+        for task in self.tasks:
+            if task[3] == name:
+                return time.ticks_diff(task[0], time.ticks_ms())
+
+    def step(self):
+
+        # 期限の来たものを呼ぶ。遅れても周期は保つが、1周以上遅れたら今から数え直す
+        ran = False
+        for task in self.tasks:
+            if time.ticks_diff(task[0], time.ticks_ms()) <= 0:
+                start = time.ticks_us()
+                task[2](0)
+                task[0] = time.ticks_add(task[0], task[1])
+                if time.ticks_diff(task[0], time.ticks_ms()) <= 0:
+                    task[0] = time.ticks_add(time.ticks_ms(), task[1])
+                self.account(task[3], time.ticks_diff(time.ticks_us(), start))
+                self.wakeCount[task[3]] += 1
+                ran = True
+
+        # 何も期限が来ていないのに起きたのはエッジのせい
+        if not ran:
+            self.account('wheel', time.ticks_diff(time.ticks_us(), self.stepUs))
+            self.wakeCount['wheel'] += 1
+
+        wait = None
+        for task in self.tasks:
+            left = time.ticks_diff(task[0], time.ticks_ms())
+            if wait is None or left < wait:
+                wait = left
+        if wait is not None and 0 < wait:
+            start = time.ticks_ms()
+            if self.lightSleep:
+                lightsleep(wait) # エッジのIRQでも戻る
+            else:
+                time.sleep_ms(wait)
+            ms = self.sleepCarry + time.ticks_diff(time.ticks_ms(), start)
+            self.sleepS += ms // 1000
+            self.sleepCarry = ms % 1000
+        self.stepUs = time.ticks_us()
+
+    def account(self, name, us):
+        us += self.awakeCarry[name]
+        self.awakeMs[name] += us // 1000
+        self.awakeCarry[name] = us % 1000
+
+    def run(self):
+        self.stepUs = time.ticks_us()
+        while True:
+            self.step()
+
+    def dump(self):
+        # 電池の持ちを見積もるための起きていた時間と眠っていた時間
+        awake = sum(self.awakeMs.values())
+        asleep = 1000 * self.sleepS + self.sleepCarry
+        for name in self.awakeMs:
+            print('%-8s %8d ms awake %6d wakes' % (name, self.awakeMs[name], self.wakeCount[name]))
+        print('%-8s %8d ms awake %8d ms asleep %.2f%%' % ('total', awake, asleep, 100 * awake / max(1, awake + asleep)))
+
+
 class Control():
     
-    def __init__(self, env, logger, counter, epd):
+    fullRefreshInterval = 12 # 1時間ごとに全体を書き換えて残像を消す。それ以外は変化した範囲だけ部分更新する。
+    textCacheSize = 40 # 軸の数字や単位はほぼ毎回同じなので覚えておく。時刻の目盛り24個と上の行の文字列が入る大きさ
+    hourLabels = tuple(str(h) for h in range(24))
+    graphTop = 24 # グラフの層は3ページ目(y=24)から
+    graphPages = 12 # 14ページ目(y=119)まで
+    graphWidth = 216
+    scaleShift = 22 # Y座標の固定小数点の桁。89 << 22でもsmall int(30ビット)に収まる
+    scaleHalf = 1 << (scaleShift - 1)
+    statsLength = 0 # 計測を残す更新の回数。0なら計らない (36で3時間分)
+    
+    def __init__(self, env, logger, counter, epd, scheduler):
         
         self.env = env
         self.logger = logger
         self.counter = counter
         
         self.epd = epd
+        self.refreshCount = 0
+        self.bootMs = None # 起動してから最初の画面を出し終わるまで[ms]
+        self.textCache = TextCache(Control.textCacheSize)
+        self.stats = CycleStats(Control.statsLength) if 0 < Control.statsLength else None
+
+        # 枠と時間軸を描いた背景。backgroundKeyが変わったときだけ描き直す
+        self.background = bytearray(len(epd.buffer))
+        self.backgroundKey = None
+
+        # グラフだけを描く層。縮尺が変わらなければ1列左へずらして新しい列だけ描き足す。
+        # ずらすときは重ならないようにもう一方のバッファへ1バイトずらしてコピーして入れ替える。
+        size = Control.graphWidth * Control.graphPages
+        self.graphBuffers = (bytearray(size), bytearray(size))
+        self.graphViews = (memoryview(self.graphBuffers[0]), memoryview(self.graphBuffers[1]))
+        self.graphs = tuple(framebuf.FrameBuffer(b, Control.graphWidth, 8 * Control.graphPages, framebuf.MONO_VLSB) for b in self.graphBuffers)
+        self.graphSide = 0
+        self.graph = self.graphs[0]
+        self.graphScale = None # 最後に描いたときの(distUpper, tempLower, tempUpper)
+        self.graphIndex = None # 最後に描いたときのlogger.currentIndex
+        self.graphLabels = None # graphScaleの目盛りの文字列
+        self.graphTotal = 0 # 最後に描いた点の累積距離[cm]
+        self.graphY = 0 # 最後に描いた点のY座標
+        self.distCoef = 0 # [cm] -> ピクセルの係数 (<< scaleShift)
+        self.tempBase = 0 # [0.1度]
+        self.tempCoef = 0 # [0.1度] -> ピクセルの係数 (<< scaleShift)。0なら温度は描かない
+        self.scrollCount = 0
+        self.plotCount = 0
         
-        self.timer = Timer()
-        self.timer.init(period = 1000 * 60 * 5, callback = self.update) #5分ごと        
         self.update(0)
+        scheduler.every(1000 * 60 * 5, self.update, 'control') #5分ごと
         
+    def text(self, s, x, y):
+        self.textCache.draw(self.epd, s, x, y)
+
+    def drawBackground(self):
+
+        key = self.env.dtTuple[4] * 12 + self.env.dtTuple[5] // 5 # 時間軸は(時, 5分枠)ごとに変わる
+        if key == self.backgroundKey:
+            self.epd.buffer[:] = self.background
+            return
+
+        self.epd.fill(0xff)
+
+        self.epd.hline(0, 119, 216, 0x00)
+        self.epd.vline(0, 30, 122 - 32, 0x00)
+        self.epd.vline(0 + 216, 30, 122 - 32, 0x00)
+
+        self.text('m', 250 - 8 * 4 - 1, 31 + 8)
+        self.epd.hline(250 - 8 * 4 - 6, 30, 5, 0x00)
+        self.text('m', 250 - 8 * 4 - 1, 32 - 1 + 44 + 8)
+        self.epd.hline(250 - 8 * 4 - 6, 74, 5, 0x00)
+        self.text('0m', 250 - 8 * 4 - 1, 121 - 9)
+
+        self.drawTimeAxis()
+
+        self.background[:] = self.epd.buffer
+        self.backgroundKey = key
+
     def drawTimeAxis(self):
         
         h = self.env.dtTuple[4]
         m = self.env.dtTuple[5]
         
         c5Index = math.floor(0.2 * m) # 12 * m / 60
-        self.epd.text('t', 0, 121, 0x00)
+        self.text('t', 0, 121)
         
         h3 = 0
         for i in range(216):
@@ -492,7 +1452,7 @@ class Control():
                 if h3 == 0:
                     x = 216 - i - (8 if 9 < h else 4)
                     if 8 < x:
-                        self.epd.text(str(h), x, 121, 0x00)
+                        self.text(Control.hourLabels[h], x, 121)
                     self.epd.vline(216 - i, 121 - 7, 6, 0x00)
                     
                 else:
@@ -502,67 +1462,180 @@ class Control():
                 h = (h - 1) % 24
         
     def update(self, t):
+
+        stats = self.stats
+        if stats:
+            stats.begin(self.logger.bytesWritten)
         
         self.env.update()
+        if stats:
+            stats.mark('env')
+        self.counter.process(0) # まだ処理されていないエッジを距離に反映してから読む
+        if stats:
+            stats.mark('counter')
         self.logger.update(self.env.tempValue, self.env.dtTuple, self.counter.distance)
         self.counter.distance = 0
+        if stats:
+            stats.mark('logger')
         
-        self.epd.init()
+        self.epd.resetStats()
+        self.epd.wake()
+        if stats:
+            stats.mark('wake')
         
-        self.epd.fill(0xff)
-        self.epd.text(self.env.dtStr, 0, 8 - 1, 0x00)
-        self.epd.text(self.env.tempStr, 200, 8 - 1, 0x00)
-        self.epd.text(self.logger.distLog, 0, 16 + 2 - 1, 0x00)
+        self.render()
+        if stats:
+            stats.mark('render')
         
-        self.epd.hline(0, 119, 216, 0x00)
-        self.epd.vline(0, 30, 122 - 32, 0x00)
-        self.epd.vline(0 + 216, 30, 122 - 32, 0x00)
-                
-        self.drawTimeAxis()
-        self.drawGraph()
-        
-        self.epd.display(self.epd.buffer)
+        if self.refreshCount % Control.fullRefreshInterval == 0:
+            self.epd.Display_Base(self.epd.buffer)
+        else:
+            region = self.epd.dirtyRegion(self.epd.buffer)
+            if region:
+                self.epd.display_Partial(self.epd.buffer, region)
+        self.refreshCount += 1
+        if stats:
+            stats.mark('display')
+
         self.epd.sleep()
+        if stats:
+            stats.mark('sleep')
+
+        # パネルが眠ったあとの待ち時間のないところで集めておき、次の更新の途中で自動のGCが走らないようにする
+        gc.collect()
+        if stats:
+            stats.mark('collect')
+            stats.end(self.epd, self.logger.bytesWritten)
+
+        if self.bootMs is None:
+            self.bootMs = time.ticks_diff(time.ticks_ms(), bootTicks)
+            print('Control.update() first frame', self.bootMs, 'ms after boot, log restore', self.logger.restoreMs, 'ms')
         
+    def render(self):
+
+        self.drawBackground()
+
+        # 時刻は毎回変わるのでキャッシュに入れず、ほかの文字列を追い出さないように直接描く
+        self.epd.text(self.env.dtStr, 0, 8 - 1, 0x00)
+        self.text(self.env.tempStr, 200, 8 - 1)
+        self.text(self.logger.distLog, 0, 16 + 2 - 1)
+        
+        self.drawGraph()
+
     def drawGraph(self):
         
-        distList = [self.logger.distance[(self.logger.currentIndex + i) % Logger.weekLength] for i in range(-1 * Logger.displayLength + 1, 1)]
-        distUpper = round(100 * math.ceil((1 + sum(distList)) / 100))            
+        distUpper = round(100 * math.ceil((1 + self.logger.sumDisplay) / 100))            
         
-        self.epd.text(str(distUpper), 250 - 8 * 4 - 1, 31, 0x00)
-        self.epd.text('m', 250 - 8 * 4 - 1, 31 + 8, 0x00)
-        self.epd.hline(250 - 8 * 4 - 6, 30, 5, 0x00)
-        self.epd.text(str(round(distUpper / 2)), 250 - 8 * 4 - 1, 32 - 1 + 44, 0x00)
-        self.epd.text('m', 250 - 8 * 4 - 1, 32 - 1 + 44 + 8, 0x00)
-        self.epd.hline(250 - 8 * 4 - 6, 74, 5, 0x00)
-        self.epd.text('0m', 250 - 8 * 4 - 1, 121 - 9, 0x00)
+        # 温度の数・最小・最大はLoggerが0.1度単位の整数で持っている
+        stats = self.logger.tempStats
+        tempLower = None
+        tempUpper = None
+        if 0 < stats.count:
+            tempLower = stats.min() // 10 # floor(min)
+            tempUpper = (stats.max() + 9) // 10 # ceil(max)
 
-        total = distList[0]        
+        # 目盛りの文字列は縮尺が変わったときだけ作る
+        scale = self.graphScale
+        rescaled = scale is None or scale[0] != distUpper or scale[1] != tempLower or scale[2] != tempUpper
+        if rescaled:
+            self.graphScale = (distUpper, tempLower, tempUpper)
+            self.graphLabels = (str(distUpper), str(round(distUpper / 2)),
+                                None if tempLower is None else str(tempUpper) + 'C',
+                                None if tempLower is None else str(tempLower) + 'C',
+                                None if tempLower is None else str(round((tempLower + tempUpper) / 2, 1)).replace('.0', 'C'))
+        labels = self.graphLabels
 
-        if 0 < distUpper:
-            for i in range(1, len(distList)):
-                self.epd.line(i - 1, 119 - round(89 * total / distUpper), i, 119 - round(89 * (total + distList[i]) / distUpper), 0x00)
-                total += distList[i]
+        self.text(labels[0], 250 - 8 * 4 - 1, 31)
+        self.text(labels[1], 250 - 8 * 4 - 1, 32 - 1 + 44)
+        if tempLower is not None:
+            self.text(labels[2], 2, 32)
+            self.epd.hline(1, 30, 5, 0x00)
+            self.text(labels[3], 2, 121 - 11)
         
-        tempList = [self.logger.temp[(self.logger.currentIndex + i) % Logger.weekLength] for i in range(-1 * Logger.displayLength + 1, 1)]    
-        tempLower = math.floor(min([x for x in tempList if 0 < x]))
-        tempUpper = math.ceil(max([x for x in tempList if 0 < x]))
-        tempWindow = tempUpper - tempLower
-        
-        self.epd.text(str(tempUpper) + 'C', 2, 32, 0x00)
-        self.epd.hline(1, 30, 5, 0x00)
-        self.epd.text(str(tempLower) + 'C', 2, 121 - 11, 0x00)
-        
-        self.epd.text(str(round((tempLower + tempUpper) / 2, 1)).replace('.0', 'C'), 2, 76, 0x00)
-        self.epd.hline(1, 74, 5, 0x00)        
+            self.text(labels[4], 2, 76)
+            self.epd.hline(1, 74, 5, 0x00)        
 
-        if 0 < tempWindow:
-            for i in range(len(tempList)):
-                if tempList[i] <= 0:
-                    continue
-            
-                self.epd.pixel(i, 119 - round(89 * (tempList[i] - tempLower) / tempWindow), 0x00)
+        # 縮尺が同じで、窓から出ていった値が0なら、残りの点は前に描いた位置から1列ずれるだけ。
+        # 新しく左端になった値も0でないと、捨てた線分の右半分が左端の列に残るので描き直す
+        idx = self.logger.currentIndex
+        if not rescaled and self.graphIndex == (idx - 1) % Logger.weekLength and self.blankAt(idx - Logger.displayLength) and self.blankAt(idx - Logger.displayLength + 1):
+            self.scrollGraph()
+            self.plotColumn()
+        else:
+            self.scaleGraph(distUpper, tempLower, tempUpper)
+            self.plotGraph()
+        self.graphIndex = idx
+
+        self.epd.blit(self.graph, 0, Control.graphTop, 1)
+
+    def blankAt(self, i):
+        # cm単位に丸めると0になる記録か
+        return int(100 * self.logger.distance[i % Logger.weekLength] + 0.5) == 0
+
+    def scaleGraph(self, distUpper, tempLower, tempUpper):
+
+        # 縮尺は1フレームに1回だけ固定小数点の係数にしておき、点ごとの計算は整数だけで行う
+        self.distCoef = ((89 << Control.scaleShift) + 50 * distUpper) // (100 * distUpper)
+        self.tempCoef = 0
+        if tempLower is not None and tempLower < tempUpper:
+            self.tempBase = 10 * tempLower
+            self.tempCoef = ((89 << Control.scaleShift) + 5 * (tempUpper - tempLower)) // (10 * (tempUpper - tempLower))
+
+    def plotGraph(self):
 
+        bottom = 119 - Control.graphTop
+        half = Control.scaleHalf
+        shift = Control.scaleShift
+        self.graph.fill(1)
+
+        # 距離はcm単位の整数にしてから累積する
+        coef = self.distCoef
+        start = self.logger.currentIndex - Logger.displayLength + 1
+        total = int(100 * self.logger.distance[start % Logger.weekLength] + 0.5)
+        y = bottom - ((total * coef + half) >> shift)
+        for i in range(1, Logger.displayLength):
+            total += int(100 * self.logger.distance[(start + i) % Logger.weekLength] + 0.5)
+            y1 = bottom - ((total * coef + half) >> shift)
+            self.graph.line(i - 1, y, i, y1, 0)
+            y = y1
+        self.graphTotal = total
+        self.graphY = y
+
+        if self.tempCoef:
+            raw = self.logger.temp.raw
+            base = self.tempBase
+            coef = self.tempCoef
+            for i in range(-1 * Logger.displayLength + 1, 1):
+                t = raw[(self.logger.currentIndex + i) % Logger.weekLength]
+                if t:
+                    self.graph.pixel(i + 215, bottom - (((t - base) * coef + half) >> shift), 0)
+        self.plotCount += 1
+
+    def scrollGraph(self):
+
+        # 1列(各ページの1バイト)左へずらして、右端の列を白にする
+        src = self.graphViews[self.graphSide]
+        self.graphSide ^= 1
+        dst = self.graphViews[self.graphSide]
+        dst[0:len(dst) - 1] = src[1:len(src)]
+        for p in range(Control.graphPages):
+            dst[p * Control.graphWidth + Control.graphWidth - 1] = 0xff
+        self.graph = self.graphs[self.graphSide]
+        self.scrollCount += 1
+
+    def plotColumn(self):
+
+        # 一番新しい点までの線と温度の点だけ描く
+        bottom = 119 - Control.graphTop
+        total = self.graphTotal + int(100 * self.logger.distance[self.logger.currentIndex] + 0.5)
+        y = bottom - ((total * self.distCoef + Control.scaleHalf) >> Control.scaleShift)
+        self.graph.line(214, self.graphY, 215, y, 0)
+        self.graphTotal = total
+        self.graphY = y
+
+        t = self.logger.temp.raw[self.logger.currentIndex]
+        if self.tempCoef and t:
+            self.graph.pixel(215, bottom - (((t - self.tempBase) * self.tempCoef + Control.scaleHalf) >> Control.scaleShift), 0)
 
 if __name__=='__main__':
 
@@ -580,11 +1653,18 @@ if __name__=='__main__':
     '''
     
     counter = Counter()
-    env = Environment(dt = (2023, 2, 27, 0, 21, 30, 0, 0))
-#    env = Environment()
+    scheduler = Scheduler(lightSleep = counter.sm is None)
+    env = Environment(scheduler, dt = (2023, 2, 27, 0, 21, 30, 0, 0))
+#    env = Environment(scheduler)
+
+    gc.collect()
+    free = gc.mem_free()
     logger = Logger(env.dtTuple, env)
+    gc.collect()
+    print('Logger', free - gc.mem_free(), 'bytes')
 
-    ctrl = Control(env, logger, counter, epd)
+    ctrl = Control(env, logger, counter, epd, scheduler)
+    scheduler.run() # Ctrl-Cで止めるとREPLに戻る
 
 
 '''